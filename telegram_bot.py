@@ -1,18 +1,31 @@
 import logging
 import json
 import os
+import functools
 from datetime import datetime
 import re
+import time
 import asyncio
 import threading
+import signal
+from concurrent.futures import ThreadPoolExecutor
 from http.server import HTTPServer, BaseHTTPRequestHandler
+import tornado.web
 import gspread
+from gspread.utils import ValueRenderOption, convert_credentials
+from google.auth.transport.requests import AuthorizedSession
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from oauth2client.service_account import ServiceAccountCredentials
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, KeyboardButton, ReplyKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
+from telegram.ext import AIORateLimiter, Application, BaseUpdateProcessor, CommandHandler, PersistenceInput, PicklePersistence, MessageHandler, CallbackQueryHandler, TypeHandler, filters, ContextTypes
 from telegram.request import HTTPXRequest
 from telegram.error import TimedOut, NetworkError, Conflict
 from dotenv import load_dotenv
+try:
+    import fcntl
+except ImportError:  # Windows'da flock yo'q, qulf tekshiruvi o'tkazib yuboriladi
+    fcntl = None
 
 # Logging sozlamalari
 logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
@@ -31,93 +44,222 @@ validate_env_vars()
 
 # Google Sheets sozlamalari
 SCOPE = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
+# sheet_call thread'lari soni; Sheets HTTP pool'i ham shu hajmda, shunda har bir thread o'z ulanishini oladi
+SHEET_WORKERS = int(os.getenv("SHEET_WORKERS", "32"))
 try:
     CREDS_JSON = json.loads(os.getenv("GOOGLE_SHEETS_CREDS"))
     CREDS = ServiceAccountCredentials.from_json_keyfile_dict(CREDS_JSON, SCOPE)
-    CLIENT = gspread.authorize(CREDS)
+    # Ulanishlarni qayta ishlatuvchi va 429/5xx javoblarni qayta urinuvchi sessiya
+    SESSION = AuthorizedSession(convert_credentials(CREDS))
+    SESSION.mount("https://", HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=SHEET_WORKERS,
+        max_retries=Retry(total=5, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504], raise_on_status=False)
+    ))
+    CLIENT = gspread.Client(auth=CREDS, session=SESSION)
     SHEET = CLIENT.open_by_key(os.getenv("SHEET_ID"))
-    HARIDORLAR_SHEET = SHEET.worksheet("Haridorlar")
-    MAHSULOTLAR_SHEET = SHEET.worksheet("Mahsulotlar")
-    BUYURTMALAR_SHEET = SHEET.worksheet("Buyurtmalar")
-    BUYURTMALAR_ARCHIVE_SHEET = None  # Arxiv varag‘i
-    GURUHLAR_SHEET = SHEET.worksheet("Guruhlar")
+    # Barcha varaqlar bitta so'rov bilan olinadi
+    WORKSHEETS = {ws.title: ws for ws in SHEET.worksheets()}
+    HARIDORLAR_SHEET = WORKSHEETS["Haridorlar"]
+    MAHSULOTLAR_SHEET = WORKSHEETS["Mahsulotlar"]
+    BUYURTMALAR_SHEET = WORKSHEETS["Buyurtmalar"]
+    BUYURTMALAR_ARCHIVE_SHEET = WORKSHEETS.get("Buyurtmalar_Archive")  # Arxiv varag‘i, yo'q bo'lsa archive_sheet() yaratadi
+    GURUHLAR_SHEET = WORKSHEETS["Guruhlar"]
 except Exception as e:
     logger.error(f"Google Sheets initialization error: {e}")
     raise
 
 # Bot sozlamalari
 BOT_TOKEN = os.getenv("BOT_TOKEN")
-ADMINS = [str(x) for x in os.getenv("ADMIN_IDS").split(",") if x]
+ADMIN_ID_LIST = tuple(x.strip() for x in os.getenv("ADMIN_IDS").split(",") if x.strip())
+if not ADMIN_ID_LIST:
+    logger.error("ADMIN_IDS tarkibida birorta ham admin ID yo'q")
+    raise ValueError("ADMIN_IDS must contain at least one admin ID")
+ADMINS = frozenset(ADMIN_ID_LIST)  # Har bir xabardagi admin tekshiruvi uchun O(1)
+# Bildirishnomalar yuboriladigan asosiy admin (ADMIN_IDS dagi birinchisi)
+ADMIN_CHAT_ID = ADMIN_ID_LIST[0]
+SHEETS_INIT_MARKER = ".sheets_initialized"  # init_sheets muvaffaqiyatli bajarilganini bildiradi
+BOT_STATE_FILE = os.getenv("BOT_STATE_FILE", "bot_state.pickle")  # Suhbat holati va savatlar saqlanadigan fayl
+BOT_STATE_SAVE_INTERVAL = 30  # soniya
+INSTANCE_LOCK = None  # BOT_STATE_FILE'dan bir vaqtda faqat bitta jarayon foydalanadi
+USER_LIST_CHUNK_SIZE = 50  # Haridorlar ro'yxatining bitta xabaridagi qatorlar soni
+MAX_CONCURRENT_UPDATES = 256  # Bir vaqtda qayta ishlanadigan yangilanishlar (turli chatlardan)
+# Har bir parallel ishlovchi Telegram so'rovi uchun ulanish kutib qolmasligi uchun MAX_CONCURRENT_UPDATES ga teng
+TELEGRAM_POOL_SIZE = int(os.getenv("TELEGRAM_POOL_SIZE", str(MAX_CONCURRENT_UPDATES)))
+WEBHOOK_MAX_CONNECTIONS = 100  # Telegram webhook'ga bir vaqtda ochadigan ulanishlar (standart 40)
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]  # Bot faqat shu yangilanishlarni qayta ishlaydi
+PHONE_RE = re.compile(r"^\+998\d{9}$")
+NUM_RE = re.compile(r"^\d+(\.\d+)?$")  # Narx, foiz va miqdor uchun manfiy bo'lmagan son
+INT_RE = re.compile(r"^\d+$")  # Savatga qo'shiladigan miqdor (butun son)
+LATLON_RE = re.compile(r"Lat:\s*([-0-9.]+),?\s*Lon:\s*([-0-9.]+)")  # "Lat:41.3 Lon:69.2" ko'rinishidagi manzil (bot manzilni doim shu prefiks bilan yozadi)
+A1_ROW_RE = re.compile(r"![A-Z]+(\d+)")  # "Haridorlar!A153:H153" diapazonidan boshlang'ich qator raqami
+# "ism|telefon|manzil|faoliyat" tahrir so'rovi: telefon va faoliyatda "|" bo'lmaydi, ism va manzilda bo'lishi mumkin
+# (telefon "+998 90 123-45-67" kabi bo'shliq va chiziqcha bilan yozilishi mumkin)
+EDIT_REQUEST_RE = re.compile(r"(.*?)\|([^|]*)\|(.*)\|([^|]*)", re.DOTALL)
+# Varaqlar sarlavhalari (ustunlar tartibi save_*/update_* funksiyalaridagi qiymatlar tartibiga mos)
+HARIDORLAR_HEADERS = ("ID", "Ism", "Telefon", "Manzil", "Faoliyat turi", "Bonus", "Tahrir So‘rovi", "Tahrir Tasdiqlangan")
+MAHSULOTLAR_HEADERS = ("Guruh nomi", "Mahsulot nomi", "Narx", "Bonus foizi", "Miqdori")
+BUYURTMALAR_HEADERS = ("Haridor ID", "Buyurtmachi ismi", "Telefon", "Manzil", "Sana", "Guruh nomi", "Mahsulotlar", "Umumiy summa", "Bonus summasi", "Confirmed")
+GURUHLAR_HEADERS = ("Guruh Nomi",)
+USERS_RANGE = "A2:H"  # Haridorlar: sarlavhasiz, faqat ishlatiladigan ustunlar
+PRODUCTS_RANGE = "A2:E"  # Mahsulotlar: guruh, nom, narx, bonus foizi, miqdor
+GROUPS_RANGE = "A2:A"  # Guruhlar: faqat nom ustuni
 
 # Global o‘zgaruvchilar
-USER_STATE = {}
-CART = {}
-BONUS_REQUESTS = {}
-USER_SELECTED_GROUP = {}
 USER_CACHE = {}
-PRODUCT_CACHE = {}
+USER_CACHE_TTL = 60  # soniya
+USER_CACHE_LOADED_AT = 0
+USER_ROW_INDEX = {}  # {user_id: qator raqami}
+PRODUCT_ROW_INDEX = {}  # {(guruh nomi, mahsulot nomi): qator raqami}
+PRODUCT_CACHE = []  # Mahsulotlar varag'idagi barcha mahsulotlar
+PRODUCT_GROUPS = {}  # {guruh nomi: [mahsulotlar]}
+PRODUCTS_BY_NAME = {}  # {guruh nomi: {mahsulot nomi: mahsulot}}
+PRODUCT_CACHE_LOADED_AT = 0
+PRODUCT_CACHE_VERSION = 0  # Har bir mahsulot yozuvida oshiriladi, fonda o'qilgan eski qatorlar yangi yozuvni bosib ketmasligi uchun
 GROUP_CACHE = None
-ORDER_CACHE = {}
+GROUP_CACHE_LOADED_AT = 0
+GROUP_CACHE_VERSION = 0  # Har bir guruh yozuvida oshiriladi (PRODUCT_CACHE_VERSION kabi)
+GROUP_ROW_INDEX = {}  # {guruh nomi: qator raqami}, guruhlar keshi bilan birga quriladi
+CATALOG_CACHE_TTL = 300  # soniya
+CACHE_REFRESH_INTERVAL = int(os.getenv("CACHE_REFRESH_INTERVAL", "50"))  # soniya, USER_CACHE_TTL dan qisqa bo'lishi kerak
+CACHE_REFRESH_TASK = None
+USER_LAST_SEEN = {}  # {Telegram user ID: oxirgi yangilanish vaqti}
+USER_DATA_IDLE_TTL = 24 * 3600  # soniya, shundan uzoq faol bo'lmagan haridorning suhbat holati o'chiriladi
+USER_DATA_CLEANUP_INTERVAL = 3600  # soniya
+USER_DATA_CLEANUP_TASK = None
+STATE_SAVE_TASK = None
+ORDER_PENDING_TTL = 30 * 24 * 3600  # soniya, shundan uzoq tasdiqlanmagan buyurtma ORDER_CACHE'dan o'chiriladi
+# Kesh muddati tugaganda bir vaqtda kelgan so'rovlar varaqni faqat bir marta o'qishi uchun
+USER_LOAD_LOCK = threading.Lock()
+PRODUCT_LOAD_LOCK = threading.Lock()
+GROUP_LOAD_LOCK = threading.Lock()
+KEYBOARD_CACHE = {}  # {(klaviatura turi, guruh nomi): mahsulotlar klaviaturasi}
+GROUP_KEYBOARD_CACHE = {}  # {callback prefiksi: guruh tanlash klaviaturasi}, guruhlar keshi bilan birga yangilanadi
+ORDER_CACHE = {}  # Admin tasdig'ini kutayotgan buyurtmalar (post_init'da bot_data["orders"] bilan bog'lanadi)
+ORDER_BUFFER = []  # Sheets'ga hali yozilmagan buyurtma qatorlari
+BONUS_BUFFER = {}  # {haridor qatori: yangi bonus}
+USER_WRITE_BUFFER = {}  # {haridor qatori: A:H qiymatlari}
+ORDER_BUFFER_LOCK = threading.Lock()
+ORDER_FLUSH_LOCK = threading.Lock()
+ORDER_FLUSH_INTERVAL = 0.5  # soniya, birinchi yozuvdan keyin shu oraliqdagi yozuvlar bitta so'rovga yig'iladi
+ORDER_FLUSH_RETRY_DELAY = 5  # soniya, yozish xatosidan keyin qayta urinishgacha
+ORDER_FLUSH_SIZE = 50
+ORDER_FLUSH_TASK = None
+ORDER_FLUSH_EVENT = None  # Navbatga yozuv tushganini bildiradi (post_init'da yaratiladi)
+EVENT_LOOP = None  # Worker thread'lar ORDER_FLUSH_EVENT'ni shu loop orqali o'rnatadi
+ORDER_NEXT_ROW = None  # Buyurtmalar varag'idagi keyingi bo'sh qator (birinchi buyurtmada bir marta o'qiladi)
+ORDER_COUNTER_LOCK = threading.Lock()
+ORDER_ROWS_CACHE = None  # Buyurtmalar varag'ining A2:J qatorlari
+ORDER_ROWS_LOADED_AT = 0
+ORDER_USER_INDEX = ([], {})  # (qatorlar, {haridor ID: [qator raqamlari]})
+ORDER_ROWS_TTL = 30  # soniya
+USER_ORDERS_BATCH_LIMIT = 100  # Bundan ko'p buyurtmada butun varaq o'qiladi
+ORDER_PAGE_SIZE = 20  # "Barcha buyurtmalar" bitta sahifasidagi buyurtmalar soni
+ORDER_SEND_CONCURRENCY = 25  # Buyurtmalar ro'yxatida bir vaqtda yuboriladigan xabarlar soni
+
+async def sheet_call(fn, *args, **kwargs):
+    """Sinxron Google Sheets chaqiruvini event loop'ni bloklamasdan alohida thread'da bajarish"""
+    return await asyncio.to_thread(fn, *args, **kwargs)
+
+def users_fresh():
+    """Haridorlar keshi yangimi (chegaradan 1 soniya oldin eskirgan deb hisoblanadi)"""
+    return time.time() - USER_CACHE_LOADED_AT < USER_CACHE_TTL - 1
+
+def products_fresh():
+    """Mahsulotlar keshi yangimi"""
+    return time.time() - PRODUCT_CACHE_LOADED_AT < CATALOG_CACHE_TTL - 1
+
+def groups_fresh():
+    """Guruhlar keshi yangimi"""
+    return GROUP_CACHE is not None and time.time() - GROUP_CACHE_LOADED_AT < CATALOG_CACHE_TTL - 1
+
+async def cached_call(fresh, fn, *args):
+    """Kesh yangi bo'lsa fn'ni to'g'ridan-to'g'ri (tarmoqsiz) chaqirish, aks holda sheet_call orqali thread'da"""
+    # Xotiradan o'qish band bo'lgan thread pool navbatida tarmoq so'rovlarini kutmaydi
+    if fresh():
+        return fn(*args)
+    return await sheet_call(fn, *args)
+
+async def send_all(*coros):
+    """Bir-biriga bog'liq bo'lmagan Telegram so'rovlarini parallel yuborish (biri xato bersa, qolganlari to'xtamaydi)"""
+    results = await asyncio.gather(*coros, return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception):
+            logger.error(f"Telegram so'rovi xatosi: {result}")
+    return results
+
+@functools.lru_cache(maxsize=4096)
+def format_som(amount):
+    """Butun summani 40 000 so'm ko'rinishida formatlash (bir xil summalar keshdan olinadi)"""
+    return format(amount, ",d").replace(",", " ") + " so'm"
 
 def format_currency(amount):
     """Narxni 40 000 so'm ko'rinishida formatlash"""
+    # Kesh kaliti butun songa keltiriladi: 40000, 40000.0 va "40000" bitta yozuvni ishlatadi
     try:
-        return f"{int(float(amount)):,d} so'm".replace(",", " ")
+        return format_som(int(float(amount)))
     except (ValueError, TypeError):
         logger.error(f"Invalid amount for formatting: {amount}")
         return "0 so'm"
 
+def chunked(items, size):
+    """Ro'yxatni size tadan bo'laklarga ajratish"""
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def sheet_cell(value):
+    """Qiymatni batch_update uchun CellData ko'rinishiga keltirish"""
+    if isinstance(value, (int, float)):
+        return {"userEnteredValue": {"numberValue": value}}
+    return {"userEnteredValue": {"stringValue": str(value)}}
+
+def appended_row_number(response):
+    """append_row javobidan qo'shilgan qator raqamini olish"""
+    try:
+        return int(A1_ROW_RE.search(response["updates"]["updatedRange"]).group(1))
+    except (KeyError, TypeError, AttributeError):
+        return None
+
+def archive_sheet(header_data=None):
+    """Buyurtmalar_Archive varag'ini olish, yo'q bo'lsa bir marta yaratib sarlavhasini yozish"""
+    global BUYURTMALAR_ARCHIVE_SHEET
+    if BUYURTMALAR_ARCHIVE_SHEET is None:
+        ws = SHEET.add_worksheet(title="Buyurtmalar_Archive", rows=1000, cols=26)
+        # header_data berilsa, sarlavha alohida so'rov bilan emas, shu ro'yxat orqali keyinroq yoziladi
+        if header_data is None:
+            ws.update(values=[list(BUYURTMALAR_HEADERS)], range_name="A1")
+        else:
+            header_data.append({"range": f"{ws.title}!A1", "values": [list(BUYURTMALAR_HEADERS)]})
+        BUYURTMALAR_ARCHIVE_SHEET = ws
+        logger.info("Buyurtmalar_Archive varag‘i yaratildi")
+    return BUYURTMALAR_ARCHIVE_SHEET
+
 def init_sheets():
     """Google Sheets sahifalarini boshlash va sarlavhalarni kiritish"""
-    global BUYURTMALAR_ARCHIVE_SHEET
     try:
-        # Haridorlar varag‘i
-        haridorlar_headers = ["ID", "Ism", "Telefon", "Manzil", "Faoliyat turi", "Bonus", "Tahrir So‘rovi", "Tahrir Tasdiqlangan"]
-        if not HARIDORLAR_SHEET.row_values(1):
-            HARIDORLAR_SHEET.append_row(haridorlar_headers)
-        else:
-            current_headers = HARIDORLAR_SHEET.row_values(1)
-            if current_headers != haridorlar_headers:
-                logger.warning(f"Haridorlar varag‘i sarlavhalari noto‘g‘ri: {current_headers}")
-                HARIDORLAR_SHEET.update(range_name="A1:H1", values=[haridorlar_headers])
-
-        # Mahsulotlar varag‘i
-        mahsulotlar_headers = ["Guruh nomi", "Mahsulot nomi", "Narx", "Bonus foizi", "Miqdori"]
-        if not MAHSULOTLAR_SHEET.row_values(1):
-            MAHSULOTLAR_SHEET.append_row(mahsulotlar_headers)
-        else:
-            current_headers = MAHSULOTLAR_SHEET.row_values(1)
-            if current_headers != mahsulotlar_headers:
-                logger.warning(f"Mahsulotlar varag‘i sarlavhalari noto‘g‘ri: {current_headers}")
-                MAHSULOTLAR_SHEET.update(range_name="A1:E1", values=[mahsulotlar_headers])
-
-        # Buyurtmalar varag‘i
-        buyurtmalar_headers = ["Haridor ID", "Buyurtmachi ismi", "Telefon", "Manzil", "Sana", "Guruh nomi", "Mahsulotlar", "Umumiy summa", "Bonus summasi", "Confirmed"]
-        if not BUYURTMALAR_SHEET.row_values(1):
-            BUYURTMALAR_SHEET.append_row(buyurtmalar_headers)
-        else:
-            current_headers = BUYURTMALAR_SHEET.row_values(1)
-            if current_headers != buyurtmalar_headers:
-                logger.warning(f"Buyurtmalar varag‘i sarlavhalari noto‘g‘ri: {current_headers}")
-                BUYURTMALAR_SHEET.update(range_name="A1:J1", values=[buyurtmalar_headers])
-
-        # Guruhlar varag‘i
-        guruhlar_headers = ["Guruh Nomi"]
-        if not GURUHLAR_SHEET.row_values(1):
-            GURUHLAR_SHEET.append_row(guruhlar_headers)
-        else:
-            current_headers = GURUHLAR_SHEET.row_values(1)
-            if current_headers != guruhlar_headers:
-                logger.warning(f"Guruhlar varag‘i sarlavhalari noto‘g‘ri: {current_headers}")
-                GURUHLAR_SHEET.update(range_name="A1:A1", values=[guruhlar_headers])
+        sheet_headers = [
+            (HARIDORLAR_SHEET, HARIDORLAR_HEADERS),
+            (MAHSULOTLAR_SHEET, MAHSULOTLAR_HEADERS),
+            (BUYURTMALAR_SHEET, BUYURTMALAR_HEADERS),
+            (GURUHLAR_SHEET, GURUHLAR_HEADERS)
+        ]
+        # Barcha varaqlarning birinchi qatori bitta batchGet so'rovi bilan o'qiladi
+        response = SHEET.values_batch_get([f"{ws.title}!1:1" for ws, _ in sheet_headers])
+        data = []
+        for (ws, headers), value_range in zip(sheet_headers, response["valueRanges"]):
+            current_headers = value_range.get("values", [[]])[0]
+            if tuple(current_headers) != headers:
+                if current_headers:
+                    logger.warning("%s varag‘i sarlavhalari noto‘g‘ri: %s", ws.title, current_headers)
+                data.append({"range": f"{ws.title}!A1", "values": [list(headers)]})
 
-        # Buyurtmalar_Archive varag‘ini boshlash
-        try:
-            BUYURTMALAR_ARCHIVE_SHEET = SHEET.worksheet("Buyurtmalar_Archive")
-        except gspread.exceptions.WorksheetNotFound:
-            BUYURTMALAR_ARCHIVE_SHEET = SHEET.add_worksheet(title="Buyurtmalar_Archive", rows=1000, cols=26)
-            BUYURTMALAR_ARCHIVE_SHEET.append_row(buyurtmalar_headers)
+        # Buyurtmalar_Archive varag‘ini boshlash (sarlavhasi qolganlari bilan birga yoziladi)
+        archive_sheet(data)
         logger.info("Buyurtmalar_Archive varag‘i tayyorlandi")
+
+        # Yetishmayotgan yoki noto‘g‘ri sarlavhalar bitta so'rov bilan yoziladi
+        if data:
+            SHEET.values_batch_update({"valueInputOption": "RAW", "data": data})
     except Exception as e:
         logger.error(f"Sheets init xatosi: {e}")
         raise
@@ -128,7 +270,7 @@ def save_user_data(user_id, data):
         if not all(key in data for key in ["name", "phone", "address", "role"]):
             logger.error(f"Missing required user data fields: {data}")
             return False
-        HARIDORLAR_SHEET.append_row([
+        values = [
             str(user_id),
             data["name"],
             data["phone"],
@@ -137,35 +279,59 @@ def save_user_data(user_id, data):
             data.get("bonus", 0),
             "",
             ""
-        ])
-        USER_CACHE[user_id] = data
-        logger.info(f"Haridor saqlandi: ID={user_id}, Bonus={data.get('bonus', 0)}")
+        ]
+        # Keshni yangilash ham varaqni o'qib keshni almashtirguncha shu lockni ushlaydi, shunda yangi haridor keshdan tushib qolmaydi
+        with ORDER_FLUSH_LOCK:
+            response = HARIDORLAR_SHEET.append_row(values)
+            row = appended_row_number(response)
+            if row:
+                USER_ROW_INDEX[str(user_id)] = row
+            USER_CACHE[str(user_id)] = user_row_to_dict(values)
+        logger.info("Haridor saqlandi: ID=%s, Bonus=%s", user_id, data.get('bonus', 0))
         return True
     except Exception as e:
         logger.error(f"Haridor saqlash xatosi: {e}")
         return False
 
-def update_user_data(user_id, data, edit_request=False):
-    """Foydalanuvchi ma'lumotlarini yangilash"""
+def find_user_row(user_id):
+    """Haridor qator raqamini topish (indeks bo'yicha, bo'lmasa find orqali)"""
+    row = USER_ROW_INDEX.get(str(user_id))
+    if row is None:
+        cell = HARIDORLAR_SHEET.find(str(user_id), in_column=1)
+        if cell is None:
+            return None
+        row = cell.row
+        USER_ROW_INDEX[str(user_id)] = row
+    return row
+
+def update_user_data(user_id, data, edit_request=False, bonus=None):
+    """Foydalanuvchi ma'lumotlarini yangilash (bonus faqat bonus= berilganda o'zgaradi)"""
     try:
-        all_values = HARIDORLAR_SHEET.get_all_values()
-        headers = all_values[0]
-        for i, row in enumerate(all_values[1:], start=2):
-            if row[0] == str(user_id):
+        get_user_data(user_id)
+        row = find_user_row(user_id)
+        if row:
+            # Joriy bonus save_order bilan bir lock ostida o'qiladi, shunda parallel buyurtma bonusi yo'qolmaydi
+            with ORDER_BUFFER_LOCK:
+                current = USER_CACHE.get(str(user_id))
+                if bonus is None:
+                    bonus = current["bonus"] if current else 0
                 values = [
                     str(user_id),
                     data["name"],
                     data["phone"],
                     data["address"],
                     data["role"],
-                    data.get("bonus", float(row[5]) if len(row) > 5 else 0),
+                    bonus,
                     data.get("edit_request", ""),
                     data.get("edit_confirmed", "")
                 ]
-                HARIDORLAR_SHEET.update(f"A{i}:H{i}", [values])
-                USER_CACHE[user_id] = data
-                logger.info(f"Haridor yangilandi: ID={user_id}, Bonus={data.get('bonus', 0)}")
-                return True
+                # Qator navbatga qo'yiladi, order_flush_loop uni keyingi batch_update bilan yozadi
+                USER_WRITE_BUFFER[row] = values
+                BONUS_BUFFER.pop(row, None)
+                USER_CACHE[str(user_id)] = user_row_to_dict(values)
+            schedule_order_flush()
+            logger.info("Haridor yangilandi: ID=%s, Bonus=%s", user_id, bonus)
+            return True
         if edit_request:
             return save_user_data(user_id, data)
         logger.error(f"Haridor topilmadi: ID={user_id}")
@@ -174,32 +340,77 @@ def update_user_data(user_id, data, edit_request=False):
         logger.error(f"Haridor yangilash xatosi: {e}")
         return False
 
+def user_row_to_dict(row):
+    """Haridorlar varag'i qatorini lug'atga aylantirish"""
+    return {
+        "id": str(row[0]),
+        "name": row[1] if len(row) > 1 else "",
+        "phone": row[2] if len(row) > 2 else "",
+        "address": row[3] if len(row) > 3 else "",
+        "role": row[4] if len(row) > 4 else "",
+        "bonus": float(row[5] or 0) if len(row) > 5 else 0,
+        "edit_request": row[6] if len(row) > 6 else "",
+        "edit_confirmed": row[7] if len(row) > 7 else ""
+    }
+
+def load_users(rows):
+    """Haridorlar varag'i qatorlaridan (sarlavhasiz, A2:H) keshni to'liq yangilash (apply_user_rows orqali chaqiriladi)"""
+    global USER_CACHE, USER_CACHE_LOADED_AT
+    USER_CACHE = {row[0]: user_row_to_dict(row) for row in rows if row and row[0]}
+    USER_ROW_INDEX.clear()
+    for i, row in enumerate(rows, start=2):
+        if row and row[0]:
+            USER_ROW_INDEX.setdefault(row[0], i)
+    USER_CACHE_LOADED_AT = time.time()
+    logger.info("Haridorlar keshi yangilandi: %s ta haridor", len(USER_CACHE))
+
+def apply_user_rows(rows):
+    """Varaqdan o'qilgan haridorlar qatorlariga navbatdagi yozuvlarni qo'yib, keshni almashtirish"""
+    # ORDER_FLUSH_LOCK ushlab turilganda chaqiriladi: o'qish va shu yerga qadar hech narsa yozilmagan bo'ladi
+    with ORDER_BUFFER_LOCK:
+        # Hali yozilmagan haridor qatorlari va bonuslar varaqdagi eski qiymatlardan yangiroq
+        rows = list(rows)
+        for user_row, values in USER_WRITE_BUFFER.items():
+            if 0 <= user_row - 2 < len(rows):
+                rows[user_row - 2] = list(values)
+        for user_row, bonus in BONUS_BUFFER.items():
+            if 0 <= user_row - 2 < len(rows):
+                row = list(rows[user_row - 2])
+                row.extend([""] * (6 - len(row)))
+                row[5] = bonus
+                rows[user_row - 2] = row
+        load_users(rows)
+
+def ensure_users_loaded():
+    """Haridorlar keshi eskirgan bo'lsa, uni bitta thread qayta yuklaydi, qolganlari kutadi"""
+    if time.time() - USER_CACHE_LOADED_AT >= USER_CACHE_TTL:
+        with USER_LOAD_LOCK:
+            if time.time() - USER_CACHE_LOADED_AT >= USER_CACHE_TTL:
+                # Navbatdagi yozuvlar keshni qayta o'qishdan oldin saqlanadi; saqlanmasa eski kesh qoldiriladi
+                if not flush_order_buffer():
+                    logger.warning("Navbatdagi yozuvlar saqlanmadi, haridorlar keshi yangilanmadi")
+                    return
+                with ORDER_FLUSH_LOCK:
+                    apply_user_rows(HARIDORLAR_SHEET.get_values(USERS_RANGE))
+
 def get_user_data(user_id):
-    """Foydalanuvchi ma'lumotlarini olish (kesh bilan)"""
+    """Foydalanuvchi ma'lumotlarini olish (TTL kesh bilan)"""
     try:
-        if user_id in USER_CACHE:
-            return USER_CACHE[user_id]
-        all_values = HARIDORLAR_SHEET.get_all_values()
-        headers = all_values[0]
-        for row in all_values[1:]:
-            if row[0] == str(user_id):
-                user_data = {
-                    "id": str(row[0]),
-                    "name": row[1] if len(row) > 1 else "",
-                    "phone": row[2] if len(row) > 2 else "",
-                    "address": row[3] if len(row) > 3 else "",
-                    "role": row[4] if len(row) > 4 else "",
-                    "bonus": float(row[5] or 0) if len(row) > 5 else 0,
-                    "edit_request": row[6] if len(row) > 6 else "",
-                    "edit_confirmed": row[7] if len(row) > 7 else ""
-                }
-                USER_CACHE[user_id] = user_data
-                return user_data
-        return None
+        ensure_users_loaded()
+        return USER_CACHE.get(str(user_id))
     except Exception as e:
         logger.error(f"Haridor ma'lumotlarini olish xatosi: {e}")
         return None
 
+def get_all_users():
+    """Barcha haridorlar ro'yxatini olish (get_user_data bilan bir xil TTL keshdan)"""
+    try:
+        ensure_users_loaded()
+        return list(USER_CACHE.values())
+    except Exception as e:
+        logger.error(f"Haridorlar ro'yxatini olish xatosi: {e}")
+        return []
+
 def save_product(data):
     """Mahsulot ma'lumotlarini Google Sheets'ga saqlash"""
     try:
@@ -213,32 +424,35 @@ def save_product(data):
             data["bonus_percent"],
             data.get("quantity", 0)
         ])
-        cache_key = data["group_name"] or "all"
-        PRODUCT_CACHE.pop(cache_key, None)
-        logger.info(f"Mahsulot qo'shildi: {data['name']} ({data['group_name']})")
+        with PRODUCT_LOAD_LOCK:
+            invalidate_products()
+        logger.info("Mahsulot qo'shildi: %s (%s)", data['name'], data['group_name'])
         return True
     except Exception as e:
         logger.error(f"Mahsulot saqlash xatosi: {e}")
         return False
 
+def find_product_row(group_name, product_name):
+    """Mahsulot qator raqamini topish (indeks mahsulotlar keshi bilan birga quriladi)"""
+    ensure_products_loaded()
+    return PRODUCT_ROW_INDEX.get((group_name, product_name))
+
 def update_product(old_name, group_name, data):
     """Mahsulot ma'lumotlarini yangilash"""
     try:
-        all_values = MAHSULOTLAR_SHEET.get_all_values()
-        headers = all_values[0]
-        for i, row in enumerate(all_values[1:], start=2):
-            if row[1] == old_name and row[0] == group_name:
-                MAHSULOTLAR_SHEET.update(f"A{i}:E{i}", [[
-                    data["group_name"],
-                    data["name"],
-                    data["price"],
-                    data["bonus_percent"],
-                    data.get("quantity", 0)
-                ]])
-                PRODUCT_CACHE.pop(group_name, None)
-                PRODUCT_CACHE.pop(data["group_name"], None)
-                logger.info(f"Mahsulot yangilandi: {old_name} -> {data['name']} ({data['group_name']})")
-                return True
+        row = find_product_row(group_name, old_name)
+        if row:
+            MAHSULOTLAR_SHEET.update(range_name=f"A{row}:E{row}", values=[[
+                data["group_name"],
+                data["name"],
+                data["price"],
+                data["bonus_percent"],
+                data.get("quantity", 0)
+            ]])
+            # Qatorlar siljimaydi, shuning uchun kesh qayta o'qilmasdan yangilanadi
+            patch_cached_product(row, old_name, group_name, data)
+            logger.info("Mahsulot yangilandi: %s -> %s (%s)", old_name, data['name'], data['group_name'])
+            return True
         logger.error(f"Mahsulot topilmadi: {old_name} ({group_name})")
         return False
     except Exception as e:
@@ -248,13 +462,14 @@ def update_product(old_name, group_name, data):
 def delete_product(product_name, group_name):
     """Mahsulotni o‘chirish"""
     try:
-        all_values = MAHSULOTLAR_SHEET.get_all_values()
-        for i, row in enumerate(all_values[1:], start=2):
-            if row[1] == product_name and row[0] == group_name:
-                MAHSULOTLAR_SHEET.delete_rows(i)
-                PRODUCT_CACHE.pop(group_name, None)
-                logger.info(f"Mahsulot o‘chirildi: {product_name} ({group_name})")
-                return True
+        row = find_product_row(group_name, product_name)
+        if row:
+            MAHSULOTLAR_SHEET.delete_rows(row)
+            # O'chirilgan qatordan keyingi qatorlar siljiydi, indeks qayta quriladi
+            with PRODUCT_LOAD_LOCK:
+                invalidate_products()
+            logger.info("Mahsulot o‘chirildi: %s (%s)", product_name, group_name)
+            return True
         logger.error(f"Mahsulot topilmadi: {product_name} ({group_name})")
         return False
     except Exception as e:
@@ -267,10 +482,20 @@ def save_group(group_name):
         if not group_name.strip():
             logger.error("Empty group name provided")
             return False
-        GURUHLAR_SHEET.append_row([group_name.strip()])
-        global GROUP_CACHE
-        GROUP_CACHE = None
-        logger.info(f"Yangi guruh qo'shildi: {group_name}")
+        response = GURUHLAR_SHEET.append_row([group_name.strip()])
+        global GROUP_CACHE, GROUP_CACHE_VERSION
+        row = appended_row_number(response)
+        with GROUP_LOAD_LOCK:
+            GROUP_CACHE_VERSION += 1
+            if GROUP_CACHE is not None and row:
+                # Yangi guruh keshga qo'shiladi, shunda keyingi so'rov varaqni qayta o'qimaydi
+                if group_name.strip() not in GROUP_ROW_INDEX:
+                    GROUP_CACHE = GROUP_CACHE + [group_name.strip()]
+                GROUP_ROW_INDEX.setdefault(group_name.strip(), row)
+                GROUP_KEYBOARD_CACHE.clear()
+            else:
+                GROUP_CACHE = None
+        logger.info("Yangi guruh qo'shildi: %s", group_name)
         return True
     except Exception as e:
         logger.error(f"Guruh qo'shish xatosi: {e}")
@@ -279,82 +504,354 @@ def save_group(group_name):
 def delete_group(group_name):
     """Guruhni o‘chirish"""
     try:
-        all_values = GURUHLAR_SHEET.get_all_values()
-        for i, row in enumerate(all_values[1:], start=2):
-            if row[0] == group_name:
-                GURUHLAR_SHEET.delete_rows(i)
-                global GROUP_CACHE
+        get_groups()
+        row = GROUP_ROW_INDEX.get(group_name)
+        if row:
+            GURUHLAR_SHEET.delete_rows(row)
+            # O'chirilgan qatordan keyingi qatorlar siljiydi, indeks qayta quriladi
+            global GROUP_CACHE, GROUP_CACHE_VERSION
+            with GROUP_LOAD_LOCK:
+                GROUP_CACHE_VERSION += 1
                 GROUP_CACHE = None
-                PRODUCT_CACHE.pop(group_name, None)
-                logger.info(f"Guruh o‘chirildi: {group_name}")
-                return True
+            logger.info("Guruh o‘chirildi: %s", group_name)
+            return True
         logger.error(f"Guruh topilmadi: {group_name}")
         return False
     except Exception as e:
         logger.error(f"Guruh o‘chirish xatosi: {e}")
         return False
 
+def invalidate_products():
+    """Mahsulotlar keshi va qator indeksini eskirgan deb belgilash (PRODUCT_LOAD_LOCK ushlab turilganda chaqiriladi)"""
+    global PRODUCT_CACHE_LOADED_AT, PRODUCT_CACHE_VERSION
+    PRODUCT_CACHE_VERSION += 1
+    PRODUCT_CACHE_LOADED_AT = 0
+    KEYBOARD_CACHE.clear()
+
+def load_products(rows=None):
+    """Mahsulotlar varag'ini (sarlavhasiz, A2:E) bir marta o'qib, kesh va qator indeksini yangilash"""
+    global PRODUCT_CACHE_LOADED_AT
+    if rows is None:
+        rows = MAHSULOTLAR_SHEET.get_values(PRODUCTS_RANGE)
+    products = []
+    row_index = {}
+    for i, row in enumerate(rows, start=2):
+        price = float(row[2] or 0) if len(row) > 2 else 0
+        products.append({
+            "group_name": row[0] if len(row) > 0 else "",
+            "name": row[1] if len(row) > 1 else "",
+            "price": price,
+            "price_fmt": format_currency(price),  # Klaviatura va ro'yxatlar uchun bir marta formatlanadi
+            "bonus_percent": float(row[3] or 0) if len(row) > 3 else 0,
+            "quantity": float(row[4] or 0) if len(row) > 4 else 0
+        })
+        if len(row) > 1:
+            row_index.setdefault((row[0], row[1]), i)
+    index_products(products, row_index)
+    PRODUCT_CACHE_LOADED_AT = time.time()
+
+def index_products(products, row_index):
+    """Mahsulotlar ro'yxatidan guruh va nom indekslarini qurish (PRODUCT_LOAD_LOCK ushlab turilganda chaqiriladi)"""
+    global PRODUCT_CACHE, PRODUCT_GROUPS, PRODUCTS_BY_NAME, PRODUCT_ROW_INDEX
+    groups = {}
+    by_name = {}
+    for p in products:
+        group = p["group_name"].strip()
+        groups.setdefault(group, []).append(p)
+        by_name.setdefault(group, {}).setdefault(p["name"], p)
+    # Lug'atlar joyida tozalanmaydi: event loop'dagi o'quvchilar yarim qurilgan indeksni ko'rmasligi uchun yangilari bir qadamda almashtiriladi
+    PRODUCT_CACHE, PRODUCT_GROUPS, PRODUCTS_BY_NAME, PRODUCT_ROW_INDEX = products, groups, by_name, row_index
+    KEYBOARD_CACHE.clear()
+
+def patch_cached_product(row, old_name, group_name, data):
+    """Tahrirlangan mahsulotni keshda joyida yangilash (varaqni qayta o'qimasdan)"""
+    global PRODUCT_CACHE_VERSION
+    with PRODUCT_LOAD_LOCK:
+        PRODUCT_CACHE_VERSION += 1
+        product = PRODUCT_CACHE[row - 2] if 0 <= row - 2 < len(PRODUCT_CACHE) else None
+        if product is None or (product["group_name"], product["name"]) != (group_name, old_name):
+            # Kesh shu orada qayta yuklangan bo'lsa, keyingi o'qishda varaqdan olinadi
+            invalidate_products()
+            return
+        price = float(data["price"] or 0)
+        product.update({
+            "group_name": data["group_name"],
+            "name": data["name"],
+            "price": price,
+            "price_fmt": format_currency(price),
+            "bonus_percent": float(data["bonus_percent"] or 0),
+            "quantity": float(data.get("quantity", 0) or 0)
+        })
+        row_index = {key: r for key, r in PRODUCT_ROW_INDEX.items() if r != row}
+        row_index.setdefault((product["group_name"], product["name"]), row)
+        index_products(PRODUCT_CACHE, row_index)
+
+def ensure_products_loaded():
+    """Mahsulotlar keshi eskirgan bo'lsa, uni bitta thread qayta yuklaydi, qolganlari kutadi"""
+    if time.time() - PRODUCT_CACHE_LOADED_AT >= CATALOG_CACHE_TTL:
+        with PRODUCT_LOAD_LOCK:
+            if time.time() - PRODUCT_CACHE_LOADED_AT >= CATALOG_CACHE_TTL:
+                load_products()
+
 def get_products(group_name=None):
-    """Mahsulotlar ro'yxatini olish (kesh bilan)"""
+    """Mahsulotlar ro'yxatini olish (TTL kesh bilan, guruh bo'yicha xotirada filtrlanadi)"""
     try:
-        cache_key = group_name or "all"
-        if cache_key in PRODUCT_CACHE:
-            return PRODUCT_CACHE[cache_key]
-        all_values = MAHSULOTLAR_SHEET.get_all_values()
-        headers = all_values[0]
-        products = []
-        for row in all_values[1:]:
-            if group_name is None or row[0].strip() == group_name.strip():
-                products.append({
-                    "group_name": row[0] if len(row) > 0 else "",
-                    "name": row[1] if len(row) > 1 else "",
-                    "price": float(row[2] or 0) if len(row) > 2 else 0,
-                    "bonus_percent": float(row[3] or 0) if len(row) > 3 else 0,
-                    "quantity": float(row[4] or 0) if len(row) > 4 else 0
-                })
-        PRODUCT_CACHE[cache_key] = products
-        return products
+        ensure_products_loaded()
+        if group_name is None:
+            return PRODUCT_CACHE
+        return PRODUCT_GROUPS.get(group_name.strip(), [])
     except Exception as e:
         logger.error(f"Mahsulotlar olish xatosi: {e}")
         return []
 
+def get_products_by_name(group_name):
+    """Guruh mahsulotlarini nomi bo'yicha lug'at ko'rinishida olish"""
+    try:
+        ensure_products_loaded()
+        return PRODUCTS_BY_NAME.get(group_name.strip(), {})
+    except Exception as e:
+        logger.error(f"Mahsulotlar olish xatosi: {e}")
+        return {}
+
+def load_groups(rows):
+    """Guruhlar keshini varaq qiymatlaridan (sarlavhasiz, A2:A) qayta qurish"""
+    global GROUP_CACHE, GROUP_CACHE_LOADED_AT
+    GROUP_CACHE = list(set(row[0].strip() for row in rows if row and row[0]))
+    GROUP_ROW_INDEX.clear()
+    for i, row in enumerate(rows, start=2):
+        if row and row[0]:
+            GROUP_ROW_INDEX.setdefault(row[0].strip(), i)
+    GROUP_KEYBOARD_CACHE.clear()
+    GROUP_CACHE_LOADED_AT = time.time()
+    return GROUP_CACHE
+
+def warm_caches():
+    """Haridorlar, Mahsulotlar, Guruhlar va buyurtmalar hisoblagichini bitta batchGet so'rovi bilan to'ldirish"""
+    global ORDER_NEXT_ROW
+    try:
+        # Navbatdagi haridor yozuvlari avval yoziladi; yozilmasa haridorlar keshi eski varaq qiymatlari bilan almashtirilmaydi
+        users_flushed = flush_order_buffer()
+        # O'qishdan keyin mahsulot yoki guruh yozilsa, o'qilgan qatorlar eskirgan bo'ladi
+        product_version = PRODUCT_CACHE_VERSION
+        group_version = GROUP_CACHE_VERSION
+        # O'qish va keshni almashtirish orasida boshqa flush varaqqa yozmasligi uchun lock ushlab turiladi
+        with ORDER_FLUSH_LOCK:
+            response = SHEET.values_batch_get([
+                f"{HARIDORLAR_SHEET.title}!{USERS_RANGE}",
+                f"{MAHSULOTLAR_SHEET.title}!{PRODUCTS_RANGE}",
+                f"{GURUHLAR_SHEET.title}!{GROUPS_RANGE}",
+                f"{BUYURTMALAR_SHEET.title}!A2:A",
+            ])
+            users, products, groups, order_ids = (value_range.get("values", []) for value_range in response["valueRanges"])
+            if users_flushed:
+                apply_user_rows(users)
+            else:
+                logger.warning("Navbatdagi yozuvlar saqlanmadi, haridorlar keshi yangilanmadi")
+            # Birinchi buyurtma hisoblagichni alohida col_values so'rovisiz oladi
+            with ORDER_COUNTER_LOCK:
+                if ORDER_NEXT_ROW is None:
+                    ORDER_NEXT_ROW = len(order_ids) + 2
+        with PRODUCT_LOAD_LOCK:
+            if product_version == PRODUCT_CACHE_VERSION:
+                load_products(products)
+        with GROUP_LOAD_LOCK:
+            if group_version == GROUP_CACHE_VERSION:
+                load_groups(groups)
+    except Exception as e:
+        logger.error(f"Keshlarni oldindan to'ldirish xatosi: {e}")
+
+async def cache_refresh_loop():
+    """Keshlarni fonda muntazam yangilab turish, shunda foydalanuvchi so'rovlari muddati o'tgan keshga tushmaydi"""
+    while True:
+        await asyncio.sleep(CACHE_REFRESH_INTERVAL)
+        await sheet_call(warm_caches)
+
 def get_groups():
-    """Guruhlar ro'yxatini olish (Guruhlar varag'idan)"""
-    global GROUP_CACHE
+    """Guruhlar ro'yxatini olish (Guruhlar varag'idan, TTL kesh bilan)"""
     try:
-        if GROUP_CACHE is not None:
+        if GROUP_CACHE is not None and time.time() - GROUP_CACHE_LOADED_AT < CATALOG_CACHE_TTL:
             return GROUP_CACHE
-        all_values = GURUHLAR_SHEET.get_all_values()
-        GROUP_CACHE = list(set(row[0].strip() for row in all_values[1:] if row and row[0]))
-        return GROUP_CACHE
+        with GROUP_LOAD_LOCK:
+            # Lock kutilayotganda boshqa thread keshni yangilagan bo'lishi mumkin
+            if GROUP_CACHE is not None and time.time() - GROUP_CACHE_LOADED_AT < CATALOG_CACHE_TTL:
+                return GROUP_CACHE
+            return load_groups(GURUHLAR_SHEET.get_values(GROUPS_RANGE))
     except Exception as e:
         logger.error(f"Guruhlar olish xatosi: {e}")
         return []
 
-def save_order(user_id, cart, address, group_name, confirmed="Yes"):
-    """Buyurtmani saqlash"""
+def archive_requests():
+    """Buyurtmalar varag'i to'lib qolsa, eski qatorlarni arxivga ko'chiruvchi batch_update so'rovlarini tayyorlash"""
+    max_qatorlar = 900
+    seed_order_counter()
+    # row_count grid o'lchami bo'lib, delete_rows'dan keyin yangilanmaydi; hisoblagich esa navbatdagi buyurtmalarni ham o'z ichiga oladi
+    with ORDER_BUFFER_LOCK:
+        oxirgi_qator = ORDER_NEXT_ROW - 1
+    if oxirgi_qator < max_qatorlar:
+        return [], 0
+    arxivlanadigan_qatorlar = oxirgi_qator - max_qatorlar + 1
+    # Sonlar arxivda ham son bo'lib qolishi uchun formatlanmagan qiymatlar o'qiladi
+    kochiriladigan_qatorlar = BUYURTMALAR_SHEET.get_values(
+        f"A2:J{arxivlanadigan_qatorlar + 1}",
+        value_render_option=ValueRenderOption.unformatted
+    )
+    if not kochiriladigan_qatorlar:
+        return [], 0
+    requests = [
+        {
+            "appendCells": {
+                "sheetId": archive_sheet().id,
+                "rows": [{"values": [sheet_cell(v) for v in row]} for row in kochiriladigan_qatorlar],
+                "fields": "userEnteredValue"
+            }
+        },
+        {
+            "deleteDimension": {
+                "range": {
+                    "sheetId": BUYURTMALAR_SHEET.id,
+                    "dimension": "ROWS",
+                    "startIndex": 1,
+                    "endIndex": len(kochiriladigan_qatorlar) + 1
+                }
+            }
+        }
+    ]
+    return requests, len(kochiriladigan_qatorlar)
+
+def flush_order_buffer():
+    """Navbatdagi buyurtmalar, haridor qatorlari va bonuslarni bitta batch_update so'rovi bilan yozish"""
+    global ORDER_NEXT_ROW
+    with ORDER_FLUSH_LOCK:
+        with ORDER_BUFFER_LOCK:
+            rows = ORDER_BUFFER[:]
+            bonuses = dict(BONUS_BUFFER)
+            user_rows = dict(USER_WRITE_BUFFER)
+            ORDER_BUFFER.clear()
+            BONUS_BUFFER.clear()
+            USER_WRITE_BUFFER.clear()
+        if not rows and not bonuses and not user_rows:
+            return True
+        try:
+            requests = []
+            archived = 0
+            if rows:
+                # Arxivga ko'chirish va o'chirish shu so'rovning boshida bajariladi, xato bo'lsa hech biri qo'llanmaydi
+                requests, archived = archive_requests()
+                requests.append({
+                    "appendCells": {
+                        "sheetId": BUYURTMALAR_SHEET.id,
+                        "rows": [{"values": [sheet_cell(v) for v in row]} for row in rows],
+                        "fields": "userEnteredValue"
+                    }
+                })
+            # Bonuslar keshdagi eng so'nggi qiymat, shuning uchun haridor qatorlaridan keyin yoziladi
+            for user_row, values in user_rows.items():
+                requests.append({
+                    "updateCells": {
+                        "range": {
+                            "sheetId": HARIDORLAR_SHEET.id,
+                            "startRowIndex": user_row - 1,
+                            "endRowIndex": user_row,
+                            "startColumnIndex": 0,
+                            "endColumnIndex": len(values)
+                        },
+                        "rows": [{"values": [sheet_cell(v) for v in values]}],
+                        "fields": "userEnteredValue"
+                    }
+                })
+            for user_row, bonus in bonuses.items():
+                requests.append({
+                    "updateCells": {
+                        "range": {
+                            "sheetId": HARIDORLAR_SHEET.id,
+                            "startRowIndex": user_row - 1,
+                            "endRowIndex": user_row,
+                            "startColumnIndex": 5,
+                            "endColumnIndex": 6
+                        },
+                        "rows": [{"values": [sheet_cell(bonus)]}],
+                        "fields": "userEnteredValue"
+                    }
+                })
+            SHEET.batch_update({"requests": requests})
+            if archived:
+                with ORDER_BUFFER_LOCK:
+                    ORDER_NEXT_ROW -= archived
+                # Qatorlar siljigani uchun kesh qayta o'qiladi
+                invalidate_orders()
+                logger.info("%s ta eski buyurtma Buyurtmalar_Archive varag'iga ko'chirildi", archived)
+            elif rows:
+                extend_order_cache(rows)
+            logger.info("Navbatdagi yozuvlar saqlandi: %s ta buyurtma, %s ta haridor, %s ta bonus", len(rows), len(user_rows), len(bonuses))
+            return True
+        except Exception as e:
+            if "exceeds grid limits" in str(e):
+                logger.error(f"Qatorlar chegarasi oshib ketdi: {e}")
+            else:
+                logger.error(f"Buyurtmalarni yozish xatosi: {e}")
+            # Yozilmagan qatorlar keyingi urinish uchun navbatga qaytariladi
+            with ORDER_BUFFER_LOCK:
+                ORDER_BUFFER[:0] = rows
+                # Keyinroq navbatga qo'yilgan haridor qatori eng so'nggi bonusni o'z ichiga oladi
+                for user_row, bonus in bonuses.items():
+                    if user_row not in USER_WRITE_BUFFER:
+                        BONUS_BUFFER.setdefault(user_row, bonus)
+                for user_row, values in user_rows.items():
+                    USER_WRITE_BUFFER.setdefault(user_row, values)
+            return False
+
+def schedule_order_flush():
+    """order_flush_loop'ni uyg'otish (istalgan thread'dan chaqirish mumkin)"""
+    if EVENT_LOOP is not None:
+        EVENT_LOOP.call_soon_threadsafe(ORDER_FLUSH_EVENT.set)
+
+async def order_flush_loop():
+    """Navbatga yozuv tushganda qisqa oraliqni kutib, yig'ilganlarini bitta so'rovda Sheets'ga yozish"""
+    while True:
+        await ORDER_FLUSH_EVENT.wait()
+        await asyncio.sleep(ORDER_FLUSH_INTERVAL)
+        # Yozish paytida kelgan yozuvlar hodisani qayta o'rnatadi
+        ORDER_FLUSH_EVENT.clear()
+        if not await sheet_call(flush_order_buffer):
+            await asyncio.sleep(ORDER_FLUSH_RETRY_DELAY)
+            ORDER_FLUSH_EVENT.set()
+
+def summarize_cart(cart, role):
+    """Savatning umumiy summasi, bonusi va matnini bitta o'tishda hisoblash"""
+    total_sum = 0
+    total_bonus = 0
+    lines = []
+    is_usta = role == "Usta"
+    for item in cart:
+        subtotal = item["price"] * item["quantity"]
+        total_sum += subtotal
+        if is_usta:
+            total_bonus += subtotal * item["bonus_percent"]
+        # Narx mahsulotlar keshida formatlangan; eski (saqlangan) savatlarda esa shu yerda formatlanadi
+        price_fmt = item.get("price_fmt") or format_currency(item["price"])
+        lines.append(f"{item['name']} - {item['quantity']} dona, narxi: {price_fmt}, jami: {format_currency(subtotal)}")
+    # Foizga bir marta, oxirida bo'linadi: har bir qatorda bo'lish kasr xatolarini yig'adi
+    return total_sum, total_bonus / 100, "\n".join(lines)
+
+def seed_order_counter():
+    """warm_caches hisoblagichni boshlay olmagan bo'lsa, uni A ustunidan bir marta o'qib boshlash"""
+    global ORDER_NEXT_ROW
+    if ORDER_NEXT_ROW is None:
+        with ORDER_COUNTER_LOCK:
+            if ORDER_NEXT_ROW is None:
+                # warm_caches bilan bir xil diapazon, shunda ikkala yo'l bir xil qatorni beradi
+                ORDER_NEXT_ROW = len(BUYURTMALAR_SHEET.get_values("A2:A")) + 2
+
+def save_order(user_id, address, group_name, total_sum, total_bonus, cart_text, confirmed="Yes", user_data=None):
+    """Buyurtmani yozish navbatiga qo'shish (user_data berilsa, haridor qayta qidirilmaydi)"""
+    global ORDER_NEXT_ROW
     try:
-        user_data = get_user_data(user_id)
+        if user_data is None:
+            user_data = get_user_data(user_id)
         if not user_data:
             logger.error(f"Haridor topilmadi: ID={user_id}")
             return None
-        total_sum = sum(item["price"] * item["quantity"] for item in cart)
-        total_bonus = sum(item["price"] * item["quantity"] * (item["bonus_percent"] / 100) for item in cart) if user_data["role"] == "Usta" else 0
-        cart_text = "\n".join([f"{item['name']} - {item['quantity']} dona, narxi: {format_currency(item['price'])}, jami: {format_currency(item['price'] * item['quantity'])}" for item in cart])
-        
-        # Qatorlar sonini tekshirish va arxivlash
-        max_qatorlar = 900
-        joriy_qator_soni = BUYURTMALAR_SHEET.row_count
-        if joriy_qator_soni >= max_qatorlar:
-            arxivlanadigan_qatorlar = joriy_qator_soni - max_qatorlar + 1
-            all_values = BUYURTMALAR_SHEET.get_all_values()
-            headers = all_values[0]
-            kochiriladigan_qatorlar = all_values[1:arxivlanadigan_qatorlar + 1]
-            BUYURTMALAR_ARCHIVE_SHEET.append_rows(kochiriladigan_qatorlar)
-            BUYURTMALAR_SHEET.delete_rows(2, arxivlanadigan_qatorlar)
-            logger.info(f"{arxivlanadigan_qatorlar} ta eski buyurtma Buyurtmalar_Archive varag'iga ko'chirildi")
-        
-        BUYURTMALAR_SHEET.append_row([
+        order_values = [
             str(user_id),
             user_data["name"],
             user_data["phone"],
@@ -365,127 +862,233 @@ def save_order(user_id, cart, address, group_name, confirmed="Yes"):
             total_sum,
             total_bonus,
             confirmed
-        ])
-        order_id = BUYURTMALAR_SHEET.row_count
-        logger.info(f"Buyurtma saqlandi: ID={user_id}, Guruh={group_name}, Bonus={total_bonus}, Order ID={order_id}, Confirmed={confirmed}")
+        ]
+        user_row = find_user_row(user_id) if total_bonus > 0 else None
+        if total_bonus > 0 and not user_row:
+            logger.error(f"Haridor topilmadi bonus yangilashda: ID={user_id}")
+        seed_order_counter()
+        # Buyurtma va bonus navbatga qo'yiladi, order_flush_loop ularni bitta so'rovda yozadi
+        with ORDER_BUFFER_LOCK:
+            ORDER_BUFFER.append(order_values)
+            if user_row:
+                # update_user_data keshdagi lug'atni almashtirgan bo'lishi mumkin, shuning uchun joriysi olinadi
+                current = USER_CACHE.get(str(user_id), user_data)
+                current["bonus"] += total_bonus
+                BONUS_BUFFER[user_row] = current["bonus"]
+            pending = len(ORDER_BUFFER)
+            order_id = ORDER_NEXT_ROW
+            ORDER_NEXT_ROW += 1
+        # Navbat to'lsa darhol yoziladi, aks holda (yoki yozish muvaffaqiyatsiz bo'lsa) order_flush_loop uyg'otiladi
+        if pending < ORDER_FLUSH_SIZE or not flush_order_buffer():
+            schedule_order_flush()
+        logger.info("Buyurtma navbatga qo'shildi: ID=%s, Guruh=%s, Bonus=%s, Order ID=%s, Confirmed=%s", user_id, group_name, total_bonus, order_id, confirmed)
         return order_id
-    except gspread.exceptions.APIError as e:
-        if "exceeds grid limits" in str(e):
-            logger.error(f"Qatorlar chegarasi oshib ketdi: {e}")
-            return None
-        else:
-            logger.error(f"Buyurtma saqlash xatosi: {e}")
-            return None
     except Exception as e:
         logger.error(f"Buyurtma saqlash xatosi: {e}")
         return None
 
-def update_bonus(user_id, bonus_amount):
-    """Haridorning bonusini yangilash"""
-    try:
-        all_values = HARIDORLAR_SHEET.get_all_values()
-        headers = all_values[0]
-        for i, row in enumerate(all_values[1:], start=2):
-            if row[0] == str(user_id):
-                current_bonus = float(row[5] or 0) if len(row) > 5 else 0
-                new_bonus = current_bonus + bonus_amount
-                HARIDORLAR_SHEET.update_cell(i, 6, new_bonus)
-                if user_id in USER_CACHE:
-                    USER_CACHE[user_id]["bonus"] = new_bonus
-                logger.info(f"Bonus yangilandi: ID={user_id}, Qo'shilgan={bonus_amount}, Umumiy={new_bonus}")
-                return True
-        logger.error(f"Haridor topilmadi bonus yangilashda: ID={user_id}")
-        return False
-    except Exception as e:
-        logger.error(f"Bonus yangilash xatosi: {e}")
-        return False
+def order_row_to_dict(row_number, row):
+    """Buyurtmalar varag'i qatorini lug'atga aylantirish"""
+    return {
+        "row": row_number,
+        "user_id": str(row[0]),
+        "user_name": row[1] if len(row) > 1 else "",
+        "phone": row[2] if len(row) > 2 else "",
+        "address": row[3] if len(row) > 3 else "",
+        "date": row[4] if len(row) > 4 else "",
+        "group_name": row[5] if len(row) > 5 else "",
+        "cart_text": row[6] if len(row) > 6 else "",
+        "total_sum": float(row[7] or 0) if len(row) > 7 else 0,
+        "bonus_sum": float(row[8] or 0) if len(row) > 8 else 0,
+        "confirmed": row[9] if len(row) > 9 else "No"
+    }
+
+def invalidate_orders():
+    """Buyurtmalar keshini eskirgan deb belgilash"""
+    global ORDER_ROWS_LOADED_AT
+    ORDER_ROWS_LOADED_AT = 0
+
+def extend_order_cache(rows):
+    """Yozilgan buyurtma qatorlarini keshga va haridor indeksiga varaqni qayta o'qimasdan qo'shish"""
+    global ORDER_ROWS_CACHE, ORDER_USER_INDEX
+    if ORDER_ROWS_CACHE is None:
+        return
+    cached, by_user = ORDER_USER_INDEX
+    # Varaqdan o'qilgan qatorlar kabi qiymatlar matn ko'rinishida saqlanadi
+    new_rows = [[str(v) for v in row] for row in rows]
+    # O'quvchilar eski juftlikni ishlatayotgan bo'lishi mumkin, shuning uchun nusxalar almashtiriladi
+    by_user = dict(by_user)
+    for i, row in enumerate(new_rows, start=len(cached) + 2):
+        by_user[row[0]] = by_user.get(row[0], []) + [i]
+    cached = cached + new_rows
+    ORDER_USER_INDEX = (cached, by_user)
+    ORDER_ROWS_CACHE = cached
+
+def get_order_rows():
+    """Buyurtmalar varag'i qatorlarini keshdan yoki Sheets'dan olish"""
+    global ORDER_ROWS_CACHE, ORDER_ROWS_LOADED_AT, ORDER_USER_INDEX, ORDER_NEXT_ROW
+    flush_order_buffer()
+    if ORDER_ROWS_CACHE is None or time.time() - ORDER_ROWS_LOADED_AT > ORDER_ROWS_TTL:
+        # O'qish paytida boshqa thread yozmasligi uchun flush lock ushlab turiladi
+        with ORDER_FLUSH_LOCK:
+            # Sarlavhasiz, faqat A:J ustunlari o'qiladi
+            rows = BUYURTMALAR_SHEET.get_values("A2:J")
+            with ORDER_BUFFER_LOCK:
+                # Navbat bo'sh bo'lsa, hisoblagich varaqdagi haqiqiy qatorlar soniga tenglashtiriladi
+                if not ORDER_BUFFER and ORDER_NEXT_ROW is not None:
+                    ORDER_NEXT_ROW = len(rows) + 2
+            by_user = {}
+            for i, row in enumerate(rows, start=2):
+                if row and row[0]:
+                    by_user.setdefault(row[0], []).append(i)
+            # Kesh lock ichida almashtiriladi, aks holda oraliqda yozilgan qatorlar eski keshga qo'shilib yo'qoladi
+            ORDER_USER_INDEX = (rows, by_user)
+            ORDER_ROWS_CACHE = rows
+            ORDER_ROWS_LOADED_AT = time.time()
+    return ORDER_ROWS_CACHE
 
 def get_orders_by_user(user_id):
     """Foydalanuvchi bo'yicha buyurtmalarni olish"""
     try:
-        all_values = BUYURTMALAR_SHEET.get_all_values()
-        headers = all_values[0]
-        orders = []
-        for i, row in enumerate(all_values[1:], start=2):
-            if row[0] == str(user_id):
-                orders.append({
-                    "row": i,
-                    "user_id": str(row[0]),
-                    "user_name": row[1] if len(row) > 1 else "",
-                    "phone": row[2] if len(row) > 2 else "",
-                    "address": row[3] if len(row) > 3 else "",
-                    "date": row[4] if len(row) > 4 else "",
-                    "group_name": row[5] if len(row) > 5 else "",
-                    "cart_text": row[6] if len(row) > 6 else "",
-                    "total_sum": float(row[7] or 0) if len(row) > 7 else 0,
-                    "bonus_sum": float(row[8] or 0) if len(row) > 8 else 0,
-                    "confirmed": row[9] if len(row) > 9 else "No"
-                })
-        return orders
+        flush_order_buffer()
+        if ORDER_ROWS_CACHE is None or time.time() - ORDER_ROWS_LOADED_AT > ORDER_ROWS_TTL:
+            # Kesh eskirgan bo'lsa, faqat A ustuni va shu foydalanuvchining qatorlari o'qiladi
+            ids = BUYURTMALAR_SHEET.col_values(1)
+            row_numbers = [i for i, value in enumerate(ids[1:], start=2) if value == str(user_id)]
+            if len(row_numbers) <= USER_ORDERS_BATCH_LIMIT:
+                if not row_numbers:
+                    return []
+                ranges = BUYURTMALAR_SHEET.batch_get([f"A{i}:J{i}" for i in row_numbers])
+                return [order_row_to_dict(i, r[0]) for i, r in zip(row_numbers, ranges) if r]
+        get_order_rows()
+        rows, by_user = ORDER_USER_INDEX
+        return [order_row_to_dict(i, rows[i - 2]) for i in by_user.get(str(user_id), [])]
     except Exception as e:
         logger.error(f"Foydalanuvchi buyurtmalarini olish xatosi: {e}")
         return []
 
-def get_all_orders():
-    """Barcha buyurtmalarni olish"""
+def get_orders_page(offset, limit):
+    """Buyurtmalarning bitta sahifasini va umumiy sonini olish (faqat sahifadagi qatorlar lug'atga aylantiriladi)"""
     try:
-        all_values = BUYURTMALAR_SHEET.get_all_values()
-        headers = all_values[0]
-        orders = []
-        for i, row in enumerate(all_values[1:], start=2):
-            orders.append({
-                "row": i,
-                "user_id": str(row[0]),
-                "user_name": row[1] if len(row) > 1 else "",
-                "phone": row[2] if len(row) > 2 else "",
-                "address": row[3] if len(row) > 3 else "",
-                "date": row[4] if len(row) > 4 else "",
-                "group_name": row[5] if len(row) > 5 else "",
-                "cart_text": row[6] if len(row) > 6 else "",
-                "total_sum": float(row[7] or 0) if len(row) > 7 else 0,
-                "bonus_sum": float(row[8] or 0) if len(row) > 8 else 0,
-                "confirmed": row[9] if len(row) > 9 else "No"
-            })
-        return orders
+        rows = get_order_rows()
+        page = rows[offset:offset + limit]
+        return [order_row_to_dict(i, row) for i, row in enumerate(page, start=offset + 2) if row and row[0]], len(rows)
     except Exception as e:
         logger.error(f"Barcha buyurtmalarni olish xatosi: {e}")
+        return [], 0
+
+def get_recent_orders(limit):
+    """Oxirgi buyurtmalarni olish (butun varaq emas, faqat oxirgi qatorlar o'qiladi)"""
+    try:
+        flush_order_buffer()
+        if ORDER_ROWS_CACHE is not None and time.time() - ORDER_ROWS_LOADED_AT <= ORDER_ROWS_TTL:
+            rows = ORDER_ROWS_CACHE[-limit:]
+            first_row = len(ORDER_ROWS_CACHE) - len(rows) + 2
+            return [order_row_to_dict(i, row) for i, row in enumerate(rows, start=first_row) if row and row[0]]
+        seed_order_counter()
+        last_row = ORDER_NEXT_ROW - 1
+        if last_row < 2:
+            return []
+        first_row = max(2, last_row - limit + 1)
+        rows = BUYURTMALAR_SHEET.get_values(f"A{first_row}:J{last_row}")
+        return [order_row_to_dict(i, row) for i, row in enumerate(rows, start=first_row) if row and row[0]]
+    except Exception as e:
+        logger.error(f"Oxirgi buyurtmalarni olish xatosi: {e}")
         return []
 
+ADMIN_MENU = ReplyKeyboardMarkup([
+    ["Yangi guruh qo'shish", "Mahsulot qo'shish"],
+    ["Mahsulotlar ma'lumotlarini o'zgartirish", "Mahsulot ro'yxati"],
+    ["Buyurtmalar ro'yxati", "Haridorlar ro'yxati"],
+    ["Guruh o‘chirish"]
+], resize_keyboard=True)
+
+ORDER_LIST_MENU = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Ohirgi buyurtma", callback_data="last_order")],
+    [InlineKeyboardButton("Ohirgi 5 ta buyurtma", callback_data="last_5_orders")],
+    [InlineKeyboardButton("Barcha buyurtmalar", callback_data="all_orders")]
+])
+
+ROLES = ("Do'kon egasi", "Qurilish kompaniyasi", "Uy egasi", "Usta")
+# O'zgarmas klaviaturalar bir marta quriladi va barcha xabarlarda qayta ishlatiladi
+ROLE_MENU = ReplyKeyboardMarkup([
+    ["Do'kon egasi", "Qurilish kompaniyasi"],
+    ["Uy egasi", "Usta"]
+], resize_keyboard=True)
+LOCATION_MENU = ReplyKeyboardMarkup([[KeyboardButton("Lokatsiyani yuborish", request_location=True)]], resize_keyboard=True)
+REGISTER_MENU = ReplyKeyboardMarkup([[KeyboardButton("Ma'lumotlaringizni saqlang")]], resize_keyboard=True)
+
+@functools.lru_cache(maxsize=8)
+def main_menu(role):
+    """Haridorning asosiy menyusi (har bir faoliyat turi uchun bir marta quriladi)"""
+    keyboard = [
+        ["Shaxsiy ma'lumotlarni o'zgartirish", "Mahsulot buyurtma qilish"],
+        ["Mening buyurtmalarim"]
+    ]
+    if role == "Usta":
+        keyboard.append(["Umumiy Bonus", "Bonusni yechish"])
+    keyboard.append(["Admin bilan bog'lanish"])
+    return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+
+@functools.lru_cache(maxsize=4096)
+def order_review_markup(buyer_id):
+    """Buyurtmani tasdiqlash/rad etish tugmalari (har bir haridor uchun bir marta quriladi)"""
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("Tasdiqlash", callback_data=f"confirm_order_{buyer_id}"),
+         InlineKeyboardButton("Rad etish", callback_data=f"reject_order_{buyer_id}")]
+    ])
+
+def group_keyboard(groups, prefix):
+    """Guruh tanlash klaviaturasi (guruhlar keshi yangilanguncha qayta ishlatiladi)"""
+    reply_markup = GROUP_KEYBOARD_CACHE.get(prefix)
+    if reply_markup is None:
+        reply_markup = InlineKeyboardMarkup([[InlineKeyboardButton(group, callback_data=f"{prefix}{group}")] for group in groups])
+        GROUP_KEYBOARD_CACHE[prefix] = reply_markup
+    return reply_markup
+
+def product_order_keyboard(group_name, products):
+    """Guruh mahsulotlarini tanlash klaviaturasi (mahsulotlar keshi yangilanguncha qayta ishlatiladi)"""
+    reply_markup = KEYBOARD_CACHE.get(("order", group_name))
+    if reply_markup is None:
+        keyboard = [[InlineKeyboardButton(f"{p['name']} ({p['price_fmt']})", callback_data=f"product_{p['name']}")] for p in products]
+        keyboard.append([InlineKeyboardButton("Savatni tasdiqlash", callback_data="confirm_cart")])
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        KEYBOARD_CACHE[("order", group_name)] = reply_markup
+    return reply_markup
+
+def product_edit_keyboard(group_name, products):
+    """Admin uchun guruh mahsulotlarini tahrirlash/o'chirish klaviaturasi (mahsulotlar keshi yangilanguncha qayta ishlatiladi)"""
+    reply_markup = KEYBOARD_CACHE.get(("edit", group_name))
+    if reply_markup is None:
+        reply_markup = InlineKeyboardMarkup([
+            [InlineKeyboardButton(f"{p['name']} ({p['price_fmt']})", callback_data=f"edit_product_{p['name']}"),
+             InlineKeyboardButton("O‘chirish", callback_data=f"delete_product_{p['name']}")]
+            for p in products
+        ])
+        KEYBOARD_CACHE[("edit", group_name)] = reply_markup
+    return reply_markup
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Botni boshlash"""
     user_id = str(update.effective_user.id)
-    user_data = get_user_data(user_id)
-    
+
     if user_id in ADMINS:
-        keyboard = [
-            ["Yangi guruh qo'shish", "Mahsulot qo'shish"],
-            ["Mahsulotlar ma'lumotlarini o'zgartirish", "Mahsulot ro'yxati"],
-            ["Buyurtmalar ro'yxati", "Haridorlar ro'yxati"],
-            ["Guruh o‘chirish"]
-        ]
-        reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-        await update.message.reply_text("Xush kelibsiz, Admin! Quyidagi amallarni bajarishingiz mumkin:", reply_markup=reply_markup)
+        await update.message.reply_text("Xush kelibsiz, Admin! Quyidagi amallarni bajarishingiz mumkin:", reply_markup=ADMIN_MENU)
     else:
+        # Admin uchun haridor ma'lumotlari kerak emas, Sheets keshiga faqat haridorlar uchun murojaat qilinadi
+        user_data = await cached_call(users_fresh, get_user_data, user_id)
         if user_data:
-            keyboard = [
-                ["Shaxsiy ma'lumotlarni o'zgartirish", "Mahsulot buyurtma qilish"],
-                ["Mening buyurtmalarim"]
-            ]
-            if user_data["role"] == "Usta":
-                keyboard.append(["Umumiy Bonus", "Bonusni yechish"])
-            keyboard.append(["Admin bilan bog'lanish"])
-            reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+            reply_markup = main_menu(user_data["role"])
             await update.message.reply_text(f"Xush kelibsiz, {user_data['name']}!", reply_markup=reply_markup)
         else:
-            keyboard = [[KeyboardButton("Ma'lumotlaringizni saqlang")]]
-            reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+            reply_markup = REGISTER_MENU
             await update.message.reply_text("Iltimos, ma'lumotlaringizni saqlang.", reply_markup=reply_markup)
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Foydalanuvchi xabarlarini qayta ishlash"""
     user_id = str(update.effective_user.id)
     text = update.message.text.strip()
-    logger.info(f"User {user_id} xabari: {text}")
+    logger.info("User %s xabari: %s", user_id, text)
 
     try:
         if user_id in ADMINS:
@@ -493,102 +1096,90 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
 
         # Handle user state for data entry first
-        if user_id in USER_STATE:
-            state = USER_STATE[user_id]
+        if "state" in context.user_data:
+            state = context.user_data["state"]
             if state["step"] == "name":
                 if not text.strip():
                     await update.message.reply_text("Iltimos, ismingizni kiriting (bo'sh bo'lmasligi kerak).")
                     return
-                USER_STATE[user_id]["name"] = text.strip()
-                USER_STATE[user_id]["step"] = "phone"
+                context.user_data["state"]["name"] = text.strip()
+                context.user_data["state"]["step"] = "phone"
                 await update.message.reply_text("Telefon raqamingizni kiriting (+998XXXXXXXXX):")
             elif state["step"] == "phone":
-                if re.match(r"^\+998\d{9}$", text):
-                    USER_STATE[user_id]["phone"] = text
-                    USER_STATE[user_id]["step"] = "location"
-                    keyboard = [[KeyboardButton("Lokatsiyani yuborish", request_location=True)]]
-                    reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+                if PHONE_RE.match(text):
+                    context.user_data["state"]["phone"] = text
+                    context.user_data["state"]["step"] = "location"
+                    reply_markup = LOCATION_MENU
                     await update.message.reply_text("Lokatsiyangizni yuboring:", reply_markup=reply_markup)
                 else:
                     await update.message.reply_text("Iltimos, to'g'ri telefon raqamini kiriting (+998XXXXXXXXX):")
             elif state["step"] == "role":
-                if text in ["Do'kon egasi", "Qurilish kompaniyasi", "Uy egasi", "Usta"]:
-                    USER_STATE[user_id]["role"] = text
+                if text in ROLES:
+                    context.user_data["state"]["role"] = text
                     data = {
-                        "name": USER_STATE[user_id]["name"],
-                        "phone": USER_STATE[user_id]["phone"],
-                        "address": USER_STATE[user_id]["address"],
+                        "name": context.user_data["state"]["name"],
+                        "phone": context.user_data["state"]["phone"],
+                        "address": context.user_data["state"]["address"],
                         "role": text,
                         "bonus": 0
                     }
-                    if save_user_data(user_id, data):
-                        del USER_STATE[user_id]
-                        keyboard = [
-                            ["Shaxsiy ma'lumotlarni o'zgartirish", "Mahsulot buyurtma qilish"],
-                            ["Mening buyurtmalarim"]
-                        ]
-                        if text == "Usta":
-                            keyboard.append(["Umumiy Bonus", "Bonusni yechish"])
-                        keyboard.append(["Admin bilan bog'lanish"])
-                        reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+                    if await sheet_call(save_user_data, user_id, data):
+                        context.user_data.pop("state", None)
+                        reply_markup = main_menu(text)
                         await update.message.reply_text("Ma'lumotlaringiz saqlandi!", reply_markup=reply_markup)
                     else:
                         await update.message.reply_text("Ma'lumotlarni saqlashda xato yuz berdi.")
                 else:
                     await update.message.reply_text("Iltimos, quyidagi variantlardan birini tanlang: Do'kon egasi, Qurilish kompaniyasi, Uy egasi, Usta")
             elif state["step"] == "quantity":
-                try:
-                    quantity = int(text)
-                    if quantity <= 0:
-                        await update.message.reply_text("Iltimos, 0 dan katta miqdor kiriting.")
-                        return
-                    product_name = USER_STATE[user_id]["product_name"]
-                    group_name = USER_SELECTED_GROUP.get(user_id, "")
-                    products = get_products(group_name)
-                    product = next((p for p in products if p["name"] == product_name), None)
-                    if product:
-                        CART[user_id].append({"name": product_name, "quantity": quantity, "price": product["price"], "bonus_percent": product["bonus_percent"]})
-                        keyboard = [[InlineKeyboardButton(f"{p['name']} ({format_currency(p['price'])})", callback_data=f"product_{p['name']}")] for p in products]
-                        keyboard.append([InlineKeyboardButton("Savatni tasdiqlash", callback_data="confirm_cart")])
-                        reply_markup = InlineKeyboardMarkup(keyboard)
-                        await update.message.reply_text(f"{product_name} ({quantity} dona) savatga qo'shildi. Yana mahsulot qo'shasizmi yoki savatni tasdiqlaysizmi?", reply_markup=reply_markup)
-                    else:
-                        await update.message.reply_text("Mahsulot topilmadi. Iltimos, qaytadan urinib ko'ring.")
-                    del USER_STATE[user_id]
-                except ValueError:
+                if not INT_RE.match(text.strip()):
                     await update.message.reply_text("Iltimos, to'g'ri miqdor kiriting (butun son).")
+                    return
+                quantity = int(text)
+                if quantity <= 0:
+                    await update.message.reply_text("Iltimos, 0 dan katta miqdor kiriting.")
+                    return
+                product_name = state["product_name"]
+                group_name = context.user_data.get("selected_group", "")
+                # Eski (narxsiz saqlangan) holatlar uchun katalogdan qidiriladi
+                product = state if "price" in state else (await cached_call(products_fresh, get_products_by_name, group_name)).get(product_name)
+                if product:
+                    context.user_data["cart"].append({"name": product_name, "quantity": quantity, "price": product["price"], "price_fmt": product["price_fmt"], "bonus_percent": product["bonus_percent"]})
+                    reply_markup = KEYBOARD_CACHE.get(("order", group_name)) or product_order_keyboard(group_name, await cached_call(products_fresh, get_products, group_name))
+                    await update.message.reply_text(f"{product_name} ({quantity} dona) savatga qo'shildi. Yana mahsulot qo'shasizmi yoki savatni tasdiqlaysizmi?", reply_markup=reply_markup)
+                else:
+                    await update.message.reply_text("Mahsulot topilmadi. Iltimos, qaytadan urinib ko'ring.")
+                context.user_data.pop("state", None)
             elif state["step"] == "edit_name":
                 if not text.strip():
                     await update.message.reply_text("Iltimos, ismingizni kiriting (bo'sh bo'lmasligi kerak).")
                     return
-                USER_STATE[user_id]["name"] = text.strip()
-                USER_STATE[user_id]["step"] = "edit_phone"
+                context.user_data["state"]["name"] = text.strip()
+                context.user_data["state"]["step"] = "edit_phone"
                 await update.message.reply_text(f"Joriy telefon: {state['current_phone']}\nYangi telefon raqamingizni kiriting (yoki o'zgartirmaslik uchun joriy telefonni qaytaring):")
             elif state["step"] == "edit_phone":
-                if re.match(r"^\+998\d{9}$", text) or text == state["current_phone"]:
-                    USER_STATE[user_id]["phone"] = text
-                    USER_STATE[user_id]["step"] = "edit_location"
-                    keyboard = [[KeyboardButton("Lokatsiyani yuborish", request_location=True)]]
-                    reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+                if PHONE_RE.match(text) or text == state["current_phone"]:
+                    context.user_data["state"]["phone"] = text
+                    context.user_data["state"]["step"] = "edit_location"
+                    reply_markup = LOCATION_MENU
                     await update.message.reply_text(f"Joriy manzil: {state['current_address']}\nYangi lokatsiyangizni yuboring (yoki o'zgartirmaslik uchun /skip buyrug'ini yuboring):", reply_markup=reply_markup)
                 else:
                     await update.message.reply_text("Iltimos, to'g'ri telefon raqamini kiriting (+998XXXXXXXXX):")
             elif state["step"] == "edit_role":
-                if text in ["Do'kon egasi", "Qurilish kompaniyasi", "Uy egasi", "Usta"] or text == state["current_role"]:
-                    USER_STATE[user_id]["role"] = text
-                    edit_request_str = f"{USER_STATE[user_id]['name']}|{USER_STATE[user_id]['phone']}|{USER_STATE[user_id]['address']}|{text}"
+                if text in ROLES or text == state["current_role"]:
+                    context.user_data["state"]["role"] = text
+                    edit_request_str = f"{state['name']}|{state['phone']}|{state['address']}|{text}"
                     data = {
-                        "name": USER_STATE[user_id]["name"],
-                        "phone": USER_STATE[user_id]["phone"],
-                        "address": USER_STATE[user_id]["address"],
+                        "name": context.user_data["state"]["name"],
+                        "phone": context.user_data["state"]["phone"],
+                        "address": context.user_data["state"]["address"],
                         "role": text,
-                        "bonus": USER_STATE[user_id]["bonus"],
                         "edit_request": edit_request_str,
                         "edit_confirmed": "No"
                     }
-                    if update_user_data(user_id, data, edit_request=True):
+                    if await sheet_call(update_user_data, user_id, data, edit_request=True):
                         await context.bot.send_message(
-                            chat_id=ADMINS[0],
+                            chat_id=ADMIN_CHAT_ID,
                             text=f"Foydalanuvchi {user_id} ({user_data['name']}) shaxsiy ma'lumotlarini o'zgartirmoqchi:\n"
                                  f"Yangi ma'lumotlar: {data['edit_request'].replace('|', ', ')}\nTasdiqlaysizmi?",
                             reply_markup=InlineKeyboardMarkup([
@@ -597,35 +1188,30 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                             ])
                         )
                         await update.message.reply_text("Ma'lumotlarni o'zgartirish so'rovi adminga yuborildi. Tasdiqlanishini kuting.")
-                        del USER_STATE[user_id]
+                        context.user_data.pop("state", None)
                     else:
                         await update.message.reply_text("Ma'lumotlarni o'zgartirish so'rovini yuborishda xato yuz berdi.")
                 else:
                     await update.message.reply_text("Iltimos, quyidagi variantlardan birini tanlang: Do'kon egasi, Qurilish kompaniyasi, Uy egasi, Usta")
             elif text == "/skip" and state["step"] == "edit_location":
-                USER_STATE[user_id]["address"] = state["current_address"]
-                USER_STATE[user_id]["step"] = "edit_role"
-                keyboard = [
-                    ["Do'kon egasi", "Qurilish kompaniyasi"],
-                    ["Uy egasi", "Usta"]
-                ]
-                reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+                context.user_data["state"]["address"] = state["current_address"]
+                context.user_data["state"]["step"] = "edit_role"
+                reply_markup = ROLE_MENU
                 await update.message.reply_text(f"Joriy faoliyat turi: {state['current_role']}\nYangi faoliyat turini tanlang (yoki o'zgartirmaslik uchun joriy turni qaytaring):", reply_markup=reply_markup)
             return
 
         # Check user data after handling state
-        user_data = get_user_data(user_id)
+        user_data = await cached_call(users_fresh, get_user_data, user_id)
         if not user_data and text != "Ma'lumotlaringizni saqlang":
             await update.message.reply_text("Iltimos, avval ma'lumotlaringizni saqlang.")
             return
 
         if text == "Ma'lumotlaringizni saqlang":
-            USER_STATE[user_id] = {"step": "name"}
+            context.user_data["state"] = {"step": "name"}
             await update.message.reply_text("Ismingizni kiriting:")
         elif text == "Shaxsiy ma'lumotlarni o'zgartirish":
-            USER_STATE[user_id] = {
+            context.user_data["state"] = {
                 "step": "edit_name",
-                "bonus": user_data["bonus"],
                 "current_name": user_data["name"],
                 "current_phone": user_data["phone"],
                 "current_address": user_data["address"],
@@ -633,16 +1219,15 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             }
             await update.message.reply_text(f"Joriy ism: {user_data['name']}\nYangi ismingizni kiriting (yoki o'zgartirmaslik uchun joriy ismni qaytaring):")
         elif text == "Mahsulot buyurtma qilish":
-            CART[user_id] = []
-            groups = get_groups()
+            context.user_data["cart"] = []
+            groups = await cached_call(groups_fresh, get_groups)
             if not groups:
                 await update.message.reply_text("Hozirda guruhlar mavjud emas.")
                 return
-            keyboard = [[InlineKeyboardButton(group, callback_data=f"group_{group}")] for group in groups]
-            reply_markup = InlineKeyboardMarkup(keyboard)
+            reply_markup = group_keyboard(groups, "group_")
             await update.message.reply_text("Mahsulot buyurtma qilish uchun guruhni tanlang:", reply_markup=reply_markup)
         elif text == "Mening buyurtmalarim":
-            orders = get_orders_by_user(user_id)
+            orders = await sheet_call(get_orders_by_user, user_id)
             if orders:
                 orders_text = []
                 for order in orders:
@@ -658,16 +1243,16 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await update.message.reply_text("\n\n".join(orders_text))
             else:
                 await update.message.reply_text("Sizda buyurtmalar yo'q.")
-            logger.info(f"User {user_id} buyurtmalarini ko'rdi")
+            logger.info("User %s buyurtmalarini ko'rdi", user_id)
         elif text == "Umumiy Bonus" and user_data["role"] == "Usta":
             await update.message.reply_text(f"Sizning umumiy bonusingiz: {format_currency(user_data['bonus'])}")
         elif text == "Bonusni yechish" and user_data["role"] == "Usta":
             if user_data["bonus"] <= 0:
                 await update.message.reply_text("Sizda yechish uchun bonus mavjud emas.")
                 return
-            BONUS_REQUESTS[user_id] = user_data["bonus"]
+            context.user_data["bonus_request"] = user_data["bonus"]
             await context.bot.send_message(
-                chat_id=ADMINS[0],
+                chat_id=ADMIN_CHAT_ID,
                 text=f"Foydalanuvchi {user_id} ({user_data['name']}) {format_currency(user_data['bonus'])} bonusni yechmoqchi. Tasdiqlaysizmi?",
                 reply_markup=InlineKeyboardMarkup([
                     [InlineKeyboardButton("Tasdiqlash", callback_data=f"approve_bonus_{user_id}"),
@@ -676,7 +1261,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             await update.message.reply_text("Bonusni yechish so'rovi adminga yuborildi.")
         elif text == "Admin bilan bog'lanish":
-            await update.message.reply_text(f"Admin bilan bog'lanish uchun: [{ADMINS[0]}](tg://user?id={ADMINS[0]})", parse_mode="Markdown")
+            await update.message.reply_text(f"Admin bilan bog'lanish uchun: [{ADMIN_CHAT_ID}](tg://user?id={ADMIN_CHAT_ID})", parse_mode="Markdown")
     except (TimedOut, NetworkError) as e:
         logger.error(f"TimedOut in handle_message: {e}")
         await update.message.reply_text("Tarmoq xatosi yuz berdi, iltimos, keyinroq urinib ko'ring.")
@@ -687,28 +1272,22 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def handle_location(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Lokatsiya qabul qilish"""
     user_id = str(update.effective_user.id)
-    if user_id in USER_STATE and USER_STATE[user_id]["step"] in ["location", "order_location", "edit_location"]:
+    if "state" in context.user_data and context.user_data["state"]["step"] in ["location", "order_location", "edit_location"]:
         location = update.message.location
         address = f"Lat:{location.latitude} Lon:{location.longitude}"
         maps_link = f"https://maps.google.com/?q={location.latitude},{location.longitude}"
-        if USER_STATE[user_id]["step"] == "location":
-            USER_STATE[user_id]["address"] = address
-            USER_STATE[user_id]["step"] = "role"
-            keyboard = [
-                ["Do'kon egasi", "Qurilish kompaniyasi"],
-                ["Uy egasi", "Usta"]
-            ]
-            reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+        if context.user_data["state"]["step"] == "location":
+            context.user_data["state"]["address"] = address
+            context.user_data["state"]["step"] = "role"
+            reply_markup = ROLE_MENU
             await update.message.reply_text("Faoliyat turini tanlang:", reply_markup=reply_markup)
-        elif USER_STATE[user_id]["step"] == "order_location":
-            user_data = get_user_data(user_id)
+        elif context.user_data["state"]["step"] == "order_location":
+            user_data = await cached_call(users_fresh, get_user_data, user_id)
             if not user_data:
                 await update.message.reply_text("Xato: Haridor ma'lumotlari topilmadi.")
                 return
-            group_name = USER_SELECTED_GROUP.get(user_id, "")
-            total_sum = sum(item["price"] * item["quantity"] for item in CART[user_id])
-            total_bonus = sum(item["price"] * item["quantity"] * (item["bonus_percent"] / 100) for item in CART[user_id]) if user_data["role"] == "Usta" else 0
-            cart_text = "\n".join([f"{item['name']} - {item['quantity']} dona, narxi: {format_currency(item['price'])}, jami: {format_currency(item['price'] * item['quantity'])}" for item in CART[user_id]])
+            group_name = context.user_data.get("selected_group", "")
+            total_sum, total_bonus, cart_text = summarize_cart(context.user_data["cart"], user_data["role"])
             temp_order = {
                 "user_id": user_id,
                 "user_name": user_data["name"],
@@ -718,70 +1297,76 @@ async def handle_location(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 "cart_text": cart_text,
                 "total_sum": total_sum,
                 "bonus_sum": total_bonus,
-                "maps_link": maps_link,
-                "cart": CART[user_id]
+                "created_at": time.time()
             }
             ORDER_CACHE[user_id] = temp_order
-            bonus_text = f"\nUshbu buyurtma uchun yig'ilgan bonus: {format_currency(total_bonus)}" if user_data["role"] == "Usta" else ""
-            await context.bot.send_message(
-                chat_id=ADMINS[0],
-                text=f"Yangi buyurtma:\nHaridor ID: {user_id}\nHaridor: [{user_data['name']}](tg://user?id={user_id})\nTelefon: {user_data['phone']}\nManzil: [{address}]({maps_link})\nGuruh: {group_name}\nMahsulotlar:\n{cart_text}\nUmumiy summa: {format_currency(total_sum)}{bonus_text}",
-                parse_mode="Markdown",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("Tasdiqlash", callback_data=f"confirm_order_{user_id}"),
-                     InlineKeyboardButton("Rad etish", callback_data=f"reject_order_{user_id}")]
-                ])
-            )
-            keyboard = [
-                ["Shaxsiy ma'lumotlarni o'zgartirish", "Mahsulot buyurtma qilish"],
-                ["Mening buyurtmalarim"]
-            ]
-            if user_data["role"] == "Usta":
-                keyboard.append(["Umumiy Bonus", "Bonusni yechish"])
-            keyboard.append(["Admin bilan bog'lanish"])
-            reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+            reply_markup = main_menu(user_data["role"])
+            # Avval haridorga javob beriladi, admin xabari fonda yuboriladi
             await update.message.reply_text("Buyurtmangiz adminga yuborildi. Tasdiqlanishini kuting.", reply_markup=reply_markup)
-            del USER_STATE[user_id]
-        elif USER_STATE[user_id]["step"] == "edit_location":
-            USER_STATE[user_id]["address"] = address
-            USER_STATE[user_id]["step"] = "edit_role"
-            keyboard = [
-                ["Do'kon egasi", "Qurilish kompaniyasi"],
-                ["Uy egasi", "Usta"]
+            lines = [
+                "Yangi buyurtma:",
+                f"Haridor ID: {user_id}",
+                f"Haridor: [{user_data['name']}](tg://user?id={user_id})",
+                f"Telefon: {user_data['phone']}",
+                f"Manzil: [{address}]({maps_link})",
+                f"Guruh: {group_name}",
+                "Mahsulotlar:",
+                cart_text,
+                f"Umumiy summa: {format_currency(total_sum)}"
             ]
-            reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-            await update.message.reply_text(f"Joriy faoliyat turi: {USER_STATE[user_id]['current_role']}\nYangi faoliyat turini tanlang (yoki o'zgartirmaslik uchun joriy turni qaytaring):", reply_markup=reply_markup)
+            if user_data["role"] == "Usta":
+                lines.append(f"Ushbu buyurtma uchun yig'ilgan bonus: {format_currency(total_bonus)}")
+            context.application.create_task(
+                context.bot.send_message(
+                    chat_id=ADMIN_CHAT_ID,
+                    text="\n".join(lines),
+                    parse_mode="Markdown",
+                    reply_markup=order_review_markup(user_id)
+                ),
+                update=update
+            )
+            context.user_data.pop("state", None)
+        elif context.user_data["state"]["step"] == "edit_location":
+            state = context.user_data["state"]
+            state["address"] = address
+            state["step"] = "edit_role"
+            reply_markup = ROLE_MENU
+            await update.message.reply_text(f"Joriy faoliyat turi: {state['current_role']}\nYangi faoliyat turini tanlang (yoki o'zgartirmaslik uchun joriy turni qaytaring):", reply_markup=reply_markup)
 
 async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Foydalanuvchi callback so'rovlarini qayta ishlash"""
     query = update.callback_query
     user_id = str(query.from_user.id)
     data = query.data
-    logger.info(f"Callback query from {user_id}: {data}")
+    logger.info("Callback query from %s: %s", user_id, data)
 
     try:
         await query.answer()
         if data.startswith("group_"):
-            group_name = data[len("group_"): ]
-            USER_SELECTED_GROUP[user_id] = group_name
-            products = get_products(group_name)
+            group_name = data.removeprefix("group_")
+            context.user_data["selected_group"] = group_name
+            products = await cached_call(products_fresh, get_products, group_name)
             if not products:
                 await query.message.reply_text(f"{group_name} guruhida mahsulotlar yo'q.")
                 return
-            keyboard = [[InlineKeyboardButton(f"{p['name']} ({format_currency(p['price'])})", callback_data=f"product_{p['name']}")] for p in products]
-            keyboard.append([InlineKeyboardButton("Savatni tasdiqlash", callback_data="confirm_cart")])
-            reply_markup = InlineKeyboardMarkup(keyboard)
+            reply_markup = product_order_keyboard(group_name, products)
             await query.message.reply_text(f"{group_name} guruhidagi mahsulotlar:", reply_markup=reply_markup)
         elif data.startswith("product_"):
-            product_name = data[len("product_"): ]
-            USER_STATE[user_id] = {"step": "quantity", "product_name": product_name}
+            product_name = data.removeprefix("product_")
+            group_name = context.user_data.get("selected_group", "")
+            product = (await cached_call(products_fresh, get_products_by_name, group_name)).get(product_name)
+            if not product:
+                await query.message.reply_text("Mahsulot topilmadi. Iltimos, qaytadan urinib ko'ring.")
+                return
+            # Narx va bonus holatga yoziladi — miqdor bosqichida katalog qayta o'qilmaydi
+            context.user_data["state"] = {"step": "quantity", "product_name": product_name, "price": product["price"], "price_fmt": product["price_fmt"], "bonus_percent": product["bonus_percent"]}
             await query.message.reply_text(f"{product_name} uchun miqdorni kiriting:")
         elif data == "confirm_cart":
-            if not CART.get(user_id):
+            if not context.user_data.get("cart"):
                 await query.message.reply_text("Savat bo'sh! Iltimos, avval mahsulot qo'shing.")
                 return
-            USER_STATE[user_id] = {"step": "order_location"}
-            await query.message.reply_text("Buyurtma yetkazib beriladigan lokatsiyani yuboring:", reply_markup=ReplyKeyboardMarkup([[KeyboardButton("Lokatsiyani yuborish", request_location=True)]], resize_keyboard=True))
+            context.user_data["state"] = {"step": "order_location"}
+            await query.message.reply_text("Buyurtma yetkazib beriladigan lokatsiyani yuboring:", reply_markup=LOCATION_MENU)
     except (TimedOut, NetworkError) as e:
         logger.error(f"TimedOut in handle_callback_query: {e}")
         await query.message.reply_text("Tarmoq xatosi yuz berdi, iltimos, keyinroq urinib ko'ring.")
@@ -789,253 +1374,329 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
         logger.error(f"Unexpected error in handle_callback_query: {e}", exc_info=True)
         await query.message.reply_text("Xato yuz berdi, iltimos, keyinroq urinib ko'ring.")
 
+async def get_user_or_reply(query, user_id, tag):
+    """Haridor ma'lumotlarini olish, topilmasa adminga xato haqida javob berish"""
+    user_data = await cached_call(users_fresh, get_user_data, user_id)
+    if not user_data:
+        await query.message.reply_text("Xato: Foydalanuvchi topilmadi!")
+        logger.error(f"{tag}: Haridor topilmadi: ID={user_id}")
+    return user_data
+
+def mark_status(query, status):
+    """Admin xabari oxiriga qaror holatini yozib, tugmalarni olib tashlash (send_all uchun coroutine qaytaradi)"""
+    return query.edit_message_text(
+        text=f"{query.message.text}\n\n**Holati: {status}**",
+        parse_mode="Markdown",
+        reply_markup=None
+    )
+
+def pop_buyer_data(context, buyer_id, *keys):
+    """Admin amalidan keyin haridorning user_data'sidan kalitlarni olib tashlash"""
+    # .get() ishlatiladi, aks holda ma'lumoti bo'lmagan haridor uchun bo'sh lug'at yaratiladi
+    buyer_data = context.application.user_data.get(int(buyer_id))
+    if buyer_data is None:
+        return
+    for key in keys:
+        buyer_data.pop(key, None)
+    # Admin yangilanishida faqat adminning ma'lumotlari saqlanadi, haridorniki alohida belgilanadi
+    context.application.mark_data_for_update_persistence(user_ids=int(buyer_id))
+
+async def admin_confirm_order(update: Update, context: ContextTypes.DEFAULT_TYPE, payload: str):
+    """Buyurtmani tasdiqlash"""
+    query = update.callback_query
+    order_user_id = payload
+    # Haridor bir marta olinadi va save_order'ga uzatiladi
+    user_data = await get_user_or_reply(query, order_user_id, "confirm_order")
+    if not user_data:
+        return
+    # Buyurtma keshdan darhol olinadi, shunda ikki marta bosilgan tugma uni ikki marta saqlamaydi
+    order = ORDER_CACHE.pop(order_user_id, None)
+    if order is None:
+        await query.message.reply_text("Xato: Buyurtma topilmadi!")
+        logger.error(f"confirm_order: Buyurtma topilmadi: User ID={order_user_id}")
+        return
+    order_row = await sheet_call(save_order, order["user_id"], order["address"], order["group_name"], order["total_sum"], order["bonus_sum"], order["cart_text"], confirmed="Yes", user_data=user_data)
+    if order_row is None:
+        ORDER_CACHE.setdefault(order_user_id, order)
+        await query.message.reply_text("Xato: Buyurtma saqlanmadi!")
+        logger.error(f"confirm_order: Buyurtma saqlanmadi: User ID={order_user_id}")
+        return
+    pop_buyer_data(context, order_user_id, "cart", "selected_group")
+    lines = [
+        "Sizning buyurtmangiz tasdiqlandi, hamkorligingizdan hursandmiz!",
+        f"Guruh: {order['group_name']}",
+        "Mahsulotlar:",
+        order["cart_text"],
+        f"Umumiy summa: {format_currency(order['total_sum'])}"
+    ]
+    if user_data["role"] == "Usta":
+        lines.append(f"Ushbu buyurtma uchun yig'ilgan bonus: {format_currency(order['bonus_sum'])}")
+        # save_order bonusni keshdagi joriy lug'atda oshiradi; u xotiradan (tarmoqsiz) o'qiladi
+        user_data = await cached_call(users_fresh, get_user_data, order_user_id) or user_data
+        lines.append(f"Umumiy bonus: {format_currency(user_data['bonus'])}")
+    await send_all(
+        context.bot.send_message(
+            chat_id=order_user_id,
+            text="\n".join(lines),
+            parse_mode="Markdown"
+        ),
+        mark_status(query, "Tasdiqlangan"),
+        query.message.reply_text(f"Buyurtma tasdiqlandi.")
+    )
+    logger.info("Buyurtma tasdiqlandi: User ID=%s, Bonus=%s", order_user_id, order['bonus_sum'])
+
+async def admin_reject_order(update: Update, context: ContextTypes.DEFAULT_TYPE, payload: str):
+    """Buyurtmani rad etish"""
+    query = update.callback_query
+    order_user_id = payload
+    if ORDER_CACHE.pop(order_user_id, None) is None:
+        await query.message.reply_text("Xato: Buyurtma topilmadi!")
+        logger.error(f"reject_order: Buyurtma topilmadi: User ID={order_user_id}")
+        return
+    pop_buyer_data(context, order_user_id, "cart", "selected_group")
+    await send_all(
+        context.bot.send_message(
+            chat_id=order_user_id,
+            text="Sizning buyurtmangiz rad etildi. Qo'shimcha ma'lumot uchun admin bilan bog'laning."
+        ),
+        mark_status(query, "Rad etildi"),
+        query.message.reply_text(f"Buyurtma rad etildi.")
+    )
+    logger.info("Buyurtma rad etildi: User ID=%s", order_user_id)
+
+async def admin_approve_bonus(update: Update, context: ContextTypes.DEFAULT_TYPE, payload: str):
+    """Bonus yechish so'rovini tasdiqlash"""
+    query = update.callback_query
+    user_id = payload
+    user_data = await get_user_or_reply(query, user_id, "approve_bonus")
+    if not user_data:
+        return
+    if not await sheet_call(update_user_data, user_id, user_data, bonus=0):
+        await query.message.reply_text("Xato: Bonus yangilanmadi!")
+        logger.error(f"approve_bonus: Bonus yangilanmadi: ID={user_id}")
+        return
+    await send_all(
+        context.bot.send_message(
+            chat_id=user_id,
+            text="Sizning bonus yechish so'rovingiz tasdiqlandi. Bonus summangiz 0 ga tenglashtirildi."
+        ),
+        mark_status(query, "Tasdiqlangan"),
+        query.message.reply_text(f"Bonus yechish tasdiqlandi.")
+    )
+    logger.info("Bonus yechish tasdiqlandi: ID=%s", user_id)
+    pop_buyer_data(context, user_id, "bonus_request")
+
+async def admin_reject_bonus(update: Update, context: ContextTypes.DEFAULT_TYPE, payload: str):
+    """Bonus yechish so'rovini rad etish"""
+    query = update.callback_query
+    user_id = payload
+    user_data = await get_user_or_reply(query, user_id, "reject_bonus")
+    if not user_data:
+        return
+    await send_all(
+        context.bot.send_message(
+            chat_id=user_id,
+            text="Sizning bonus yechish so'rovingiz rad etildi. Qo'shimcha ma'lumot uchun admin bilan bog'laning."
+        ),
+        mark_status(query, "Rad etildi"),
+        query.message.reply_text(f"Bonus yechish rad etildi.")
+    )
+    logger.info("Bonus yechish rad etildi: ID=%s", user_id)
+    pop_buyer_data(context, user_id, "bonus_request")
+
+async def admin_approve_edit(update: Update, context: ContextTypes.DEFAULT_TYPE, payload: str):
+    """Ma'lumotlarni o'zgartirish so'rovini tasdiqlash"""
+    query = update.callback_query
+    user_id = payload
+    user_data = await get_user_or_reply(query, user_id, "approve_edit")
+    if not user_data:
+        return
+    try:
+        match = EDIT_REQUEST_RE.fullmatch(user_data["edit_request"])
+        if not match:
+            await query.message.reply_text("Xato: Tahrir so‘rovi noto‘g‘ri formatda!")
+            logger.error(f"approve_edit: Noto‘g‘ri tahrir so‘rovi: {user_data['edit_request']}")
+            return
+        name, phone, address, role = (value.strip() for value in match.groups())
+        updated_data = {
+            "name": name,
+            "phone": phone,
+            "address": address,
+            "role": role,
+            "edit_request": "",
+            "edit_confirmed": "Yes"
+        }
+        if await sheet_call(update_user_data, user_id, updated_data):
+            await send_all(
+                context.bot.send_message(
+                    chat_id=user_id,
+                    text="Sizning shaxsiy ma'lumotlaringiz muvaffaqiyatli yangilandi!"
+                ),
+                mark_status(query, "Tasdiqlangan"),
+                query.message.reply_text(f"Ma'lumotlarni o'zgartirish tasdiqlandi.")
+            )
+            logger.info("Ma'lumotlarni o'zgartirish tasdiqlandi: ID=%s", user_id)
+        else:
+            await query.message.reply_text("Xato: Ma'lumotlar yangilanmadi!")
+            logger.error(f"approve_edit: Ma'lumotlar yangilanmadi: ID={user_id}")
+    except Exception as e:
+        await query.message.reply_text("Xato: Ma'lumotlarni yangilashda xato yuz berdi!")
+        logger.error(f"approve_edit: Xato: {e}")
+
+async def admin_reject_edit(update: Update, context: ContextTypes.DEFAULT_TYPE, payload: str):
+    """Ma'lumotlarni o'zgartirish so'rovini rad etish"""
+    query = update.callback_query
+    user_id = payload
+    user_data = await get_user_or_reply(query, user_id, "reject_edit")
+    if not user_data:
+        return
+    user_data["edit_request"] = ""
+    user_data["edit_confirmed"] = "Rejected"
+    if not await sheet_call(update_user_data, user_id, user_data):
+        await query.message.reply_text("Xato: Ma'lumotlar yangilanmadi!")
+        logger.error(f"reject_edit: Ma'lumotlar yangilanmadi: ID={user_id}")
+        return
+    await send_all(
+        context.bot.send_message(
+            chat_id=user_id,
+            text="Ma'lumotlarni o'zgartirish so'rovingiz rad etildi. Qo'shimcha ma'lumot uchun admin bilan bog'laning."
+        ),
+        mark_status(query, "Rad etildi"),
+        query.message.reply_text(f"Ma'lumotlarni o'zgartirish rad etildi.")
+    )
+    logger.info("Ma'lumotlarni o'zgartirish rad etildi: ID=%s", user_id)
+
+async def admin_edit_product(update: Update, context: ContextTypes.DEFAULT_TYPE, payload: str):
+    """Mahsulotni tahrirlashni boshlash"""
+    query = update.callback_query
+    user_id = str(query.from_user.id)
+    product_name = payload
+    group_name = context.user_data.get("selected_group", "")
+    product = (await cached_call(products_fresh, get_products_by_name, group_name)).get(product_name)
+    if not product:
+        await query.message.reply_text("Xato: Mahsulot topilmadi!")
+        logger.error(f"edit_product: Mahsulot topilmadi: {product_name} ({group_name})")
+        return
+    context.user_data["state"] = {
+        "step": "edit_product_name",
+        "old_product_name": product_name,
+        "old_group_name": group_name,
+        "current_name": product["name"],
+        "current_price": product["price"],
+        "current_bonus_percent": product["bonus_percent"],
+        "current_quantity": product["quantity"]
+    }
+    await query.message.reply_text(
+        f"Joriy mahsulot: {product_name} ({group_name})\n"
+        f"Nom: {product['name']}\n"
+        f"Narx: {product['price_fmt']}\n"
+        f"Bonus foizi: {product['bonus_percent']}%\n"
+        f"Miqdori: {product['quantity']} dona\n"
+        f"Yangi nom kiriting (yoki o'zgartirmaslik uchun joriy nomni qaytaring):"
+    )
+    logger.info("Admin %s mahsulotni tahrirlashni boshladi: %s (%s)", user_id, product_name, group_name)
+
+async def admin_delete_product(update: Update, context: ContextTypes.DEFAULT_TYPE, payload: str):
+    """Mahsulotni o'chirish"""
+    query = update.callback_query
+    user_id = str(query.from_user.id)
+    product_name = payload
+    group_name = context.user_data.get("selected_group", "")
+    if await sheet_call(delete_product, product_name, group_name):
+        await query.message.reply_text(f"Mahsulot o‘chirildi: {product_name} ({group_name})")
+        logger.info("Admin %s mahsulotni o‘chirdi: %s (%s)", user_id, product_name, group_name)
+    else:
+        await query.message.reply_text("Xato: Mahsulot o‘chirilmadi!")
+        logger.error(f"Admin {user_id} mahsulot o‘chirishda xato: {product_name} ({group_name})")
+
+async def admin_delete_group(update: Update, context: ContextTypes.DEFAULT_TYPE, payload: str):
+    """Guruhni o'chirish"""
+    query = update.callback_query
+    user_id = str(query.from_user.id)
+    group_name = payload
+    if await sheet_call(delete_group, group_name):
+        await query.message.reply_text(f"Guruh o‘chirildi: {group_name}")
+        logger.info("Admin %s guruhni o‘chirdi: %s", user_id, group_name)
+    else:
+        await query.message.reply_text("Xato: Guruh o‘chirilmadi!")
+        logger.error(f"Admin {user_id} guruh o‘chirishda xato: {group_name}")
+
+async def admin_select_group_edit(update: Update, context: ContextTypes.DEFAULT_TYPE, payload: str):
+    """Tahrirlash uchun guruh mahsulotlarini ko'rsatish"""
+    query = update.callback_query
+    group_name = payload
+    context.user_data["selected_group"] = group_name
+    products = await cached_call(products_fresh, get_products, group_name)
+    if not products:
+        await query.message.reply_text(f"{group_name} guruhida mahsulotlar yo'q.")
+        return
+    reply_markup = product_edit_keyboard(group_name, products)
+    await query.message.reply_text(f"{group_name} guruhidagi mahsulotlarni tanlang:", reply_markup=reply_markup)
+
+async def admin_select_group_add(update: Update, context: ContextTypes.DEFAULT_TYPE, payload: str):
+    """Guruhga yangi mahsulot qo'shishni boshlash"""
+    query = update.callback_query
+    user_id = str(query.from_user.id)
+    group_name = payload
+    context.user_data["selected_group"] = group_name
+    context.user_data["state"] = {"step": "product_name"}
+    await query.message.reply_text(f"{group_name} guruhiga yangi mahsulot nomini kiriting:")
+    logger.info("Admin %s mahsulot qo'shishni boshladi: Guruh=%s", user_id, group_name)
+
+async def admin_show_orders(update: Update, context: ContextTypes.DEFAULT_TYPE, payload: str):
+    """Buyurtmalar ro'yxatini tanlangan rejimda ko'rsatish"""
+    await show_orders(update, context, mode=ORDER_LIST_MODES[payload])
+
+async def admin_orders_page(update: Update, context: ContextTypes.DEFAULT_TYPE, payload: str):
+    """Barcha buyurtmalarning keyingi sahifasini ko'rsatish"""
+    await show_orders(update, context, mode="all", offset=int(payload) if payload.isdigit() else 0)
+
+# callback_data -> show_orders rejimi
+ORDER_LIST_MODES = {"last_order": "last", "last_5_orders": "last_5", "all_orders": "all"}
+# {prefiks: ishlovchi}, prefiksdan keyingi qism ishlovchiga payload sifatida beriladi
+ADMIN_CALLBACK_PREFIXES = {
+    "confirm_order_": admin_confirm_order,
+    "reject_order_": admin_reject_order,
+    "approve_bonus_": admin_approve_bonus,
+    "reject_bonus_": admin_reject_bonus,
+    "approve_edit_": admin_approve_edit,
+    "reject_edit_": admin_reject_edit,
+    "edit_product_": admin_edit_product,
+    "delete_product_": admin_delete_product,
+    "select_group_edit_": admin_select_group_edit,
+    "select_group_add_": admin_select_group_add,
+    "orders_page_": admin_orders_page,
+    "delete_group_": admin_delete_group,
+}
+# Har bir prefiks o'z nomli guruhiga ega, match.lastgroup qaysi ishlovchi kerakligini bildiradi
+ADMIN_CALLBACK_HANDLERS = {prefix.rstrip("_"): handler for prefix, handler in ADMIN_CALLBACK_PREFIXES.items()}
+ADMIN_CALLBACK_HANDLERS.update(dict.fromkeys(ORDER_LIST_MODES, admin_show_orders))
+ADMIN_CALLBACK_RE = re.compile(
+    "^(?:"
+    + "|".join(f"{re.escape(prefix)}(?P<{prefix.rstrip('_')}>.*)" for prefix in ADMIN_CALLBACK_PREFIXES)
+    + "|"
+    + "|".join(f"(?P<{name}>{name})$" for name in ORDER_LIST_MODES)
+    + ")",
+    re.DOTALL
+)
+
 async def handle_admin_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Admin callback so'rovlarini qayta ishlash"""
     query = update.callback_query
     user_id = str(query.from_user.id)
     data = query.data
-    logger.info(f"Admin callback from {user_id}: {data}")
+    logger.info("Admin callback from %s: %s", user_id, data)
 
     try:
-        await query.answer()
+        # Tugmaga javob fonda yuboriladi: ishlovchi (masalan, buyurtmani saqlash) bu so'rovni kutmaydi
+        context.application.create_task(query.answer(), update=update)
         if user_id not in ADMINS:
             await query.message.reply_text("Sizda admin huquqlari yo'q.")
             return
-        if data.startswith("confirm_order_"):
-            order_user_id = data[len("confirm_order_"): ]
-            if order_user_id not in ORDER_CACHE:
-                await query.message.reply_text("Xato: Buyurtma topilmadi!")
-                logger.error(f"confirm_order: Buyurtma topilmadi: User ID={order_user_id}")
-                return
-            order = ORDER_CACHE[order_user_id]
-            order_row = save_order(order["user_id"], order["cart"], order["address"], order["group_name"], confirmed="Yes")
-            if order_row is None:
-                await query.message.reply_text("Xato: Buyurtma saqlanmadi!")
-                logger.error(f"confirm_order: Buyurtma saqlanmadi: User ID={order_user_id}")
-                return
-            if order["bonus_sum"] > 0:
-                update_bonus(order_user_id, order["bonus_sum"])
-            user_data = get_user_data(order_user_id)
-            if not user_data:
-                await query.message.reply_text("Xato: Foydalanuvchi topilmadi!")
-                logger.error(f"confirm_order: Haridor topilmadi: ID={order_user_id}")
-                return
-            bonus_text = f"\nUshbu buyurtma uchun yig'ilgan bonus: {format_currency(order['bonus_sum'])}\nUmumiy bonus: {format_currency(user_data['bonus'])}" if user_data["role"] == "Usta" else ""
-            await context.bot.send_message(
-                chat_id=order_user_id,
-                text=f"Sizning buyurtmangiz tasdiqlandi, hamkorligingizdan hursandmiz!\nGuruh: {order['group_name']}\nMahsulotlar:\n{order['cart_text']}\nUmumiy summa: {format_currency(order['total_sum'])}{bonus_text}",
-                parse_mode="Markdown"
-            )
-            await query.edit_message_text(
-                text=query.message.text + "\n\n**Holati: Tasdiqlangan**",
-                parse_mode="Markdown",
-                reply_markup=None
-            )
-            await query.message.reply_text(f"Buyurtma tasdiqlandi.")
-            logger.info(f"Buyurtma tasdiqlandi: User ID={order_user_id}, Bonus={order['bonus_sum']}")
-            del ORDER_CACHE[order_user_id]
-            del CART[order_user_id]
-            del USER_SELECTED_GROUP[order_user_id]
-        elif data.startswith("reject_order_"):
-            order_user_id = data[len("reject_order_"): ]
-            if order_user_id not in ORDER_CACHE:
-                await query.message.reply_text("Xato: Buyurtma topilmadi!")
-                logger.error(f"reject_order: Buyurtma topilmadi: User ID={order_user_id}")
-                return
-            order = ORDER_CACHE[order_user_id]
-            await context.bot.send_message(
-                chat_id=order_user_id,
-                text="Sizning buyurtmangiz rad etildi. Qo'shimcha ma'lumot uchun admin bilan bog'laning."
-            )
-            await query.edit_message_text(
-                text=query.message.text + "\n\n**Holati: Rad etildi**",
-                parse_mode="Markdown",
-                reply_markup=None
-            )
-            await query.message.reply_text(f"Buyurtma rad etildi.")
-            logger.info(f"Buyurtma rad etildi: User ID={order_user_id}")
-            del ORDER_CACHE[order_user_id]
-            del CART[order_user_id]
-            del USER_SELECTED_GROUP[order_user_id]
-        elif data.startswith("approve_bonus_"):
-            user_id = data[len("approve_bonus_"): ]
-            user_data = get_user_data(user_id)
-            if not user_data:
-                await query.message.reply_text("Xato: Foydalanuvchi topilmadi!")
-                logger.error(f"approve_bonus: Haridor topilmadi: ID={user_id}")
-                return
-            user_data["bonus"] = 0
-            if not update_user_data(user_id, user_data):
-                await query.message.reply_text("Xato: Bonus yangilanmadi!")
-                logger.error(f"approve_bonus: Bonus yangilanmadi: ID={user_id}")
-                return
-            await context.bot.send_message(
-                chat_id=user_id,
-                text="Sizning bonus yechish so'rovingiz tasdiqlandi. Bonus summangiz 0 ga tenglashtirildi."
-            )
-            await query.edit_message_text(
-                text=query.message.text + "\n\n**Holati: Tasdiqlangan**",
-                parse_mode="Markdown",
-                reply_markup=None
-            )
-            await query.message.reply_text(f"Bonus yechish tasdiqlandi.")
-            logger.info(f"Bonus yechish tasdiqlandi: ID={user_id}")
-            del BONUS_REQUESTS[user_id]
-        elif data.startswith("reject_bonus_"):
-            user_id = data[len("reject_bonus_"): ]
-            user_data = get_user_data(user_id)
-            if not user_data:
-                await query.message.reply_text("Xato: Foydalanuvchi topilmadi!")
-                logger.error(f"reject_bonus: Haridor topilmadi: ID={user_id}")
-                return
-            await context.bot.send_message(
-                chat_id=user_id,
-                text="Sizning bonus yechish so'rovingiz rad etildi. Qo'shimcha ma'lumot uchun admin bilan bog'laning."
-            )
-            await query.edit_message_text(
-                text=query.message.text + "\n\n**Holati: Rad etildi**",
-                parse_mode="Markdown",
-                reply_markup=None
-            )
-            await query.message.reply_text(f"Bonus yechish rad etildi.")
-            logger.info(f"Bonus yechish rad etildi: ID={user_id}")
-            del BONUS_REQUESTS[user_id]
-        elif data.startswith("approve_edit_"):
-            user_id = data[len("approve_edit_"): ]
-            user_data = get_user_data(user_id)
-            if not user_data:
-                await query.message.reply_text("Xato: Foydalanuvchi topilmadi!")
-                logger.error(f"approve_edit: Haridor topilmadi: ID={user_id}")
-                return
-            try:
-                new_data = user_data["edit_request"].split("|")
-                if len(new_data) != 4:
-                    await query.message.reply_text("Xato: Tahrir so‘rovi noto‘g‘ri formatda!")
-                    logger.error(f"approve_edit: Noto‘g‘ri tahrir so‘rovi: {user_data['edit_request']}")
-                    return
-                updated_data = {
-                    "name": new_data[0].strip(),
-                    "phone": new_data[1].strip(),
-                    "address": new_data[2].strip(),
-                    "role": new_data[3].strip(),
-                    "bonus": user_data["bonus"],
-                    "edit_request": "",
-                    "edit_confirmed": "Yes"
-                }
-                if update_user_data(user_id, updated_data):
-                    await context.bot.send_message(
-                        chat_id=user_id,
-                        text="Sizning shaxsiy ma'lumotlaringiz muvaffaqiyatli yangilandi!"
-                    )
-                    await query.edit_message_text(
-                        text=query.message.text + "\n\n**Holati: Tasdiqlangan**",
-                        parse_mode="Markdown",
-                        reply_markup=None
-                    )
-                    await query.message.reply_text(f"Ma'lumotlarni o'zgartirish tasdiqlandi.")
-                    logger.info(f"Ma'lumotlarni o'zgartirish tasdiqlandi: ID={user_id}")
-                else:
-                    await query.message.reply_text("Xato: Ma'lumotlar yangilanmadi!")
-                    logger.error(f"approve_edit: Ma'lumotlar yangilanmadi: ID={user_id}")
-            except Exception as e:
-                await query.message.reply_text("Xato: Ma'lumotlarni yangilashda xato yuz berdi!")
-                logger.error(f"approve_edit: Xato: {e}")
-        elif data.startswith("reject_edit_"):
-            user_id = data[len("reject_edit_"): ]
-            user_data = get_user_data(user_id)
-            if not user_data:
-                await query.message.reply_text("Xato: Foydalanuvchi topilmadi!")
-                logger.error(f"reject_edit: Haridor topilmadi: ID={user_id}")
-                return
-            user_data["edit_request"] = ""
-            user_data["edit_confirmed"] = "Rejected"
-            if not update_user_data(user_id, user_data):
-                await query.message.reply_text("Xato: Ma'lumotlar yangilanmadi!")
-                logger.error(f"reject_edit: Ma'lumotlar yangilanmadi: ID={user_id}")
-                return
-            await context.bot.send_message(
-                chat_id=user_id,
-                text="Ma'lumotlarni o'zgartirish so'rovingiz rad etildi. Qo'shimcha ma'lumot uchun admin bilan bog'laning."
-            )
-            await query.edit_message_text(
-                text=query.message.text + "\n\n**Holati: Rad etildi**",
-                parse_mode="Markdown",
-                reply_markup=None
-            )
-            await query.message.reply_text(f"Ma'lumotlarni o'zgartirish rad etildi.")
-            logger.info(f"Ma'lumotlarni o'zgartirish rad etildi: ID={user_id}")
-        elif data.startswith("edit_product_"):
-            product_name = data[len("edit_product_"): ]
-            group_name = USER_SELECTED_GROUP.get(user_id, "")
-            product = next((p for p in get_products(group_name) if p["name"] == product_name), None)
-            if not product:
-                await query.message.reply_text("Xato: Mahsulot topilmadi!")
-                logger.error(f"edit_product: Mahsulot topilmadi: {product_name} ({group_name})")
-                return
-            USER_STATE[user_id] = {
-                "step": "edit_product_name",
-                "old_product_name": product_name,
-                "old_group_name": group_name,
-                "current_name": product["name"],
-                "current_price": product["price"],
-                "current_bonus_percent": product["bonus_percent"],
-                "current_quantity": product["quantity"]
-            }
-            await query.message.reply_text(
-                f"Joriy mahsulot: {product_name} ({group_name})\n"
-                f"Nom: {product['name']}\n"
-                f"Narx: {format_currency(product['price'])}\n"
-                f"Bonus foizi: {product['bonus_percent']}%\n"
-                f"Miqdori: {product['quantity']} dona\n"
-                f"Yangi nom kiriting (yoki o'zgartirmaslik uchun joriy nomni qaytaring):"
-            )
-            logger.info(f"Admin {user_id} mahsulotni tahrirlashni boshladi: {product_name} ({group_name})")
-        elif data.startswith("delete_product_"):
-            product_name = data[len("delete_product_"): ]
-            group_name = USER_SELECTED_GROUP.get(user_id, "")
-            if delete_product(product_name, group_name):
-                await query.message.reply_text(f"Mahsulot o‘chirildi: {product_name} ({group_name})")
-                logger.info(f"Admin {user_id} mahsulotni o‘chirdi: {product_name} ({group_name})")
-            else:
-                await query.message.reply_text("Xato: Mahsulot o‘chirilmadi!")
-                logger.error(f"Admin {user_id} mahsulot o‘chirishda xato: {product_name} ({group_name})")
-        elif data.startswith("select_group_edit_"):
-            group_name = data[len("select_group_edit_"): ]
-            USER_SELECTED_GROUP[user_id] = group_name
-            products = get_products(group_name)
-            if not products:
-                await query.message.reply_text(f"{group_name} guruhida mahsulotlar yo'q.")
-                return
-            keyboard = [
-                [InlineKeyboardButton(f"{p['name']} ({format_currency(p['price'])})", callback_data=f"edit_product_{p['name']}"),
-                 InlineKeyboardButton("O‘chirish", callback_data=f"delete_product_{p['name']}")]
-                for p in products
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.message.reply_text(f"{group_name} guruhidagi mahsulotlarni tanlang:", reply_markup=reply_markup)
-        elif data.startswith("select_group_add_"):
-            group_name = data[len("select_group_add_"): ]
-            USER_SELECTED_GROUP[user_id] = group_name
-            USER_STATE[user_id] = {"step": "product_name"}
-            await query.message.reply_text(f"{group_name} guruhiga yangi mahsulot nomini kiriting:")
-            logger.info(f"Admin {user_id} mahsulot qo'shishni boshladi: Guruh={group_name}")
-        elif data.startswith("group_"):
-            group_name = data[len("group_"): ]
-            USER_SELECTED_GROUP[user_id] = group_name
-            products = get_products(group_name)
-            if not products:
-                await query.message.reply_text(f"{group_name} guruhida mahsulotlar yo'q.")
-                return
-            text = f"{group_name} guruhidagi mahsulotlar:\n"
-            for p in products:
-                text += f"  • {p['name']}: {p['quantity']} dona, Narx: {format_currency(p['price'])}, Bonus: {p['bonus_percent']}%\n"
-            await query.message.reply_text(text, parse_mode="Markdown")
-        elif data == "last_order":
-            await show_orders(update, context, mode="last")
-        elif data == "last_5_orders":
-            await show_orders(update, context, mode="last_5")
-        elif data == "all_orders":
-            await show_orders(update, context, mode="all")
+        match = context.matches[0]
+        handler = ADMIN_CALLBACK_HANDLERS.get(match.lastgroup)
+        if handler:
+            await handler(update, context, match[match.lastgroup])
     except (TimedOut, NetworkError) as e:
         logger.error(f"TimedOut in handle_admin_callback: {e}")
         await query.message.reply_text("Tarmoq xatosi yuz berdi, iltimos, keyinroq urinib ko'ring.")
@@ -1043,39 +1704,36 @@ async def handle_admin_callback(update: Update, context: ContextTypes.DEFAULT_TY
         logger.error(f"Unexpected error in handle_admin_callback: {e}", exc_info=True)
         await query.message.reply_text("Xato yuz berdi, iltimos, keyinroq urinib ko'ring.")
 
-async def show_orders(update: Update, context: ContextTypes.DEFAULT_TYPE, mode: str):
-    """Buyurtmalarni ko'rsatish funksiyasi"""
+async def show_orders(update: Update, context: ContextTypes.DEFAULT_TYPE, mode: str, offset: int = 0):
+    """Buyurtmalarni ko'rsatish funksiyasi ("all" rejimida ORDER_PAGE_SIZE tadan sahifalab)"""
     query = update.callback_query
     user_id = str(query.from_user.id)
-    orders = get_all_orders()
-    if not orders:
-        await query.message.reply_text("Hozirda buyurtmalar yo'q.")
-        return
-
+    total = 0
     if mode == "last":
-        selected_orders = [orders[-1]]
+        selected_orders = await sheet_call(get_recent_orders, 1)
     elif mode == "last_5":
-        selected_orders = orders[-5:]
+        selected_orders = await sheet_call(get_recent_orders, 5)
     elif mode == "all":
-        selected_orders = orders
+        selected_orders, total = await sheet_call(get_orders_page, offset, ORDER_PAGE_SIZE)
     else:
         selected_orders = []
+    if not selected_orders:
+        await query.message.reply_text("Hozirda buyurtmalar yo'q.")
+        return
 
-    for order in selected_orders:
-        user_data = get_user_data(order["user_id"])
+    # Haridorlar bitta chaqiruvda keshdan olinadi (kesh yangi bo'lsa thread'ga o'tilmaydi)
+    buyers = await cached_call(users_fresh, lambda: [get_user_data(order["user_id"]) for order in selected_orders])
+    messages = []
+    for order, user_data in zip(selected_orders, buyers):
         if not user_data:
-            await query.message.reply_text(f"Buyurtma uchun foydalanuvchi topilmadi: {order['user_name']}")
             logger.error(f"Buyurtmalar ro'yxati: Haridor topilmadi: ID={order['user_id']}")
+            messages.append((f"Buyurtma uchun foydalanuvchi topilmadi: {order['user_name']}", {}))
             continue
         bonus_text = f"Bonus summasi: {format_currency(order['bonus_sum'])}" if order["bonus_sum"] > 0 else ""
-        maps_link = f"https://maps.google.com/?q={order['address'].split('Lat:')[1].split(' Lon:')[0]},{order['address'].split(' Lon:')[1]}" if "Lat:" in order["address"] else order["address"]
-        buttons = []
-        if order["confirmed"] == "No":
-            buttons = [
-                [InlineKeyboardButton("Tasdiqlash", callback_data=f"confirm_order_{order['user_id']}"),
-                 InlineKeyboardButton("Rad etish", callback_data=f"reject_order_{order['user_id']}")]
-            ]
-        await query.message.reply_text(
+        latlon = LATLON_RE.match(order["address"])
+        maps_link = f"https://maps.google.com/?q={latlon[1]},{latlon[2]}" if latlon else order["address"]
+        reply_markup = order_review_markup(order["user_id"]) if order["confirmed"] == "No" else None
+        messages.append((
             f"Buyurtma:\n"
             f"Haridor ID: {order['user_id']}\n"
             f"Haridor: [{order['user_name']}](tg://user?id={order['user_id']})\n"
@@ -1087,256 +1745,291 @@ async def show_orders(update: Update, context: ContextTypes.DEFAULT_TYPE, mode:
             f"Umumiy summa: {format_currency(order['total_sum'])}\n"
             f"{bonus_text}\n"
             f"Holat: {'Tasdiqlangan' if order['confirmed'] == 'Yes' else 'Rad etildi' if order['confirmed'] == 'Rejected' else 'Tasdiqlanmagan'}",
-            parse_mode="Markdown",
-            reply_markup=InlineKeyboardMarkup(buttons)
+            {"parse_mode": "Markdown", "reply_markup": reply_markup}
+        ))
+
+    # Xabarlar parallel yuboriladi, bir vaqtda ORDER_SEND_CONCURRENCY tadan oshmaydi (Telegram ~30 xabar/s)
+    semaphore = asyncio.Semaphore(ORDER_SEND_CONCURRENCY)
+
+    async def send(text, kwargs):
+        async with semaphore:
+            return await query.message.reply_text(text, **kwargs)
+
+    await send_all(*(send(text, kwargs) for text, kwargs in messages))
+    # Bo'sh qatorlar tashlab ketilgani uchun sahifa chegarasi qatorlar bo'yicha hisoblanadi
+    next_offset = min(offset + ORDER_PAGE_SIZE, total)
+    if next_offset < total:
+        # Keyingi sahifa tugmasi barcha buyurtmalar yuborilgandan keyin chiqadi
+        await query.message.reply_text(
+            f"Ko'rsatildi: {offset + 1}-{next_offset} / {total}",
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(f"Keyingi {ORDER_PAGE_SIZE} ta", callback_data=f"orders_page_{next_offset}")]])
         )
-    logger.info(f"Admin {user_id} {mode} buyurtmalarni ko'rdi")
+    logger.info("Admin %s %s buyurtmalarni ko'rdi", user_id, mode)
+
+async def admin_step_group_name(update: Update, context: ContextTypes.DEFAULT_TYPE, state: dict):
+    """Yangi guruh nomini qabul qilish"""
+    user_id = str(update.effective_user.id)
+    text = update.message.text.strip()
+    if not text.strip():
+        await update.message.reply_text("Iltimos, guruh nomini kiriting (bo'sh bo'lmasligi kerak).")
+        return
+    if await sheet_call(save_group, text):
+        await update.message.reply_text(f"Guruh qo'shildi: {text}")
+        logger.info("Admin %s yangi guruh qo'shdi: %s", user_id, text)
+    else:
+        await update.message.reply_text("Guruh qo'shishda xato yuz berdi.")
+    context.user_data.pop("state", None)
+
+async def admin_step_product_name(update: Update, context: ContextTypes.DEFAULT_TYPE, state: dict):
+    """Yangi mahsulot nomini qabul qilish"""
+    user_id = str(update.effective_user.id)
+    text = update.message.text.strip()
+    if not text.strip():
+        await update.message.reply_text("Iltimos, mahsulot nomini kiriting (bo'sh bo'lmasligi kerak).")
+        return
+    context.user_data["state"]["product_name"] = text.strip()
+    context.user_data["state"]["step"] = "product_price"
+    await update.message.reply_text("Mahsulot narxini kiriting:")
+    logger.info("Admin %s mahsulot nomi kiritdi: %s", user_id, text)
+
+async def admin_step_product_price(update: Update, context: ContextTypes.DEFAULT_TYPE, state: dict):
+    """Yangi mahsulot narxini qabul qilish"""
+    user_id = str(update.effective_user.id)
+    text = update.message.text.strip()
+    if not NUM_RE.match(text):
+        await update.message.reply_text("Iltimos, to'g'ri narx kiriting (masalan, 40000).")
+        logger.warning("Admin %s noto'g'ri narx formati kiritdi: %s", user_id, text)
+        return
+    price = float(text)
+    if price <= 0:
+        await update.message.reply_text("Iltimos, 0 dan katta narx kiriting.")
+        logger.warning("Admin %s noto'g'ri narx kiritdi: %s", user_id, text)
+        return
+    context.user_data["state"]["product_price"] = price
+    context.user_data["state"]["step"] = "product_bonus"
+    await update.message.reply_text("Usta uchun bonus foizini kiriting (%):")
+    logger.info("Admin %s mahsulot narxini kiritdi: %s", user_id, price)
+
+async def admin_step_product_bonus(update: Update, context: ContextTypes.DEFAULT_TYPE, state: dict):
+    """Yangi mahsulot bonus foizini qabul qilish"""
+    user_id = str(update.effective_user.id)
+    text = update.message.text.strip()
+    if not NUM_RE.match(text):
+        await update.message.reply_text("Iltimos, to'g'ri foiz kiriting (masalan, 12.5).")
+        logger.warning("Admin %s noto'g'ri bonus foizi formati kiritdi: %s", user_id, text)
+        return
+    bonus_percent = float(text)
+    context.user_data["state"]["product_bonus"] = bonus_percent
+    context.user_data["state"]["step"] = "product_quantity"
+    await update.message.reply_text("Mahsulot miqdorini kiriting (dona):")
+    logger.info("Admin %s bonus foizini kiritdi: %s", user_id, bonus_percent)
+
+async def admin_step_product_quantity(update: Update, context: ContextTypes.DEFAULT_TYPE, state: dict):
+    """Yangi mahsulot miqdorini qabul qilib, mahsulotni saqlash"""
+    user_id = str(update.effective_user.id)
+    text = update.message.text.strip()
+    if not NUM_RE.match(text):
+        await update.message.reply_text("Iltimos, to'g'ri miqdor kiriting (masalan, 50).")
+        logger.warning("Admin %s noto'g'ri miqdor formati kiritdi: %s", user_id, text)
+        return
+    quantity = float(text)
+    data = {
+        "group_name": context.user_data.get("selected_group", ""),
+        "name": context.user_data["state"]["product_name"],
+        "price": context.user_data["state"]["product_price"],
+        "bonus_percent": context.user_data["state"]["product_bonus"],
+        "quantity": quantity
+    }
+    if await sheet_call(save_product, data):
+        await update.message.reply_text(f"Mahsulot qo'shildi: {data['name']} ({data['group_name']})")
+        logger.info("Admin %s yangi mahsulot qo'shdi: %s (%s)", user_id, data['name'], data['group_name'])
+    else:
+        await update.message.reply_text("Mahsulot qo'shishda xato yuz berdi.")
+    context.user_data.pop("state", None)
+    context.user_data.pop("selected_group", None)
+
+async def admin_step_edit_product_name(update: Update, context: ContextTypes.DEFAULT_TYPE, state: dict):
+    """Tahrirlanayotgan mahsulotning yangi nomini qabul qilish"""
+    user_id = str(update.effective_user.id)
+    text = update.message.text.strip()
+    if not text.strip():
+        await update.message.reply_text("Iltimos, mahsulot nomini kiriting (bo'sh bo'lmasligi kerak).")
+        logger.warning("Admin %s bo'sh mahsulot nomi kiritdi", user_id)
+        return
+    context.user_data["state"]["new_product_name"] = text.strip()
+    context.user_data["state"]["step"] = "edit_product_price"
+    await update.message.reply_text(
+        f"Yangi nom saqlandi: {text.strip()}\n"
+        f"Joriy narx: {format_currency(state['current_price'])}\n"
+        f"Yangi narx kiriting (yoki o'zgartirmaslik uchun joriy narxni qaytaring):"
+    )
+    logger.info("Admin %s yangi mahsulot nomi kiritdi: %s", user_id, text.strip())
+
+async def admin_step_edit_product_price(update: Update, context: ContextTypes.DEFAULT_TYPE, state: dict):
+    """Tahrirlanayotgan mahsulotning yangi narxini qabul qilish"""
+    user_id = str(update.effective_user.id)
+    text = update.message.text.strip()
+    if not NUM_RE.match(text):
+        await update.message.reply_text("Iltimos, to'g'ri narx kiriting (masalan, 40000).")
+        logger.warning("Admin %s noto'g'ri narx formati kiritdi: %s", user_id, text)
+        return
+    price = float(text)
+    if price <= 0:
+        await update.message.reply_text("Iltimos, 0 dan katta narx kiriting.")
+        logger.warning("Admin %s noto'g'ri narx kiritdi: %s", user_id, text)
+        return
+    context.user_data["state"]["new_price"] = price
+    context.user_data["state"]["step"] = "edit_product_bonus"
+    await update.message.reply_text(
+        f"Yangi narx saqlandi: {format_currency(price)}\n"
+        f"Joriy bonus foizi: {state['current_bonus_percent']}%\n"
+        f"Yangi bonus foizini kiriting (yoki o'zgartirmaslik uchun joriy foizni qaytaring):"
+    )
+    logger.info("Admin %s yangi narx kiritdi: %s", user_id, price)
+
+async def admin_step_edit_product_bonus(update: Update, context: ContextTypes.DEFAULT_TYPE, state: dict):
+    """Tahrirlanayotgan mahsulotning yangi bonus foizini qabul qilish"""
+    user_id = str(update.effective_user.id)
+    text = update.message.text.strip()
+    if not NUM_RE.match(text):
+        await update.message.reply_text("Iltimos, to'g'ri foiz kiriting (masalan, 12.5).")
+        logger.warning("Admin %s noto'g'ri bonus foizi formati kiritdi: %s", user_id, text)
+        return
+    bonus_percent = float(text)
+    context.user_data["state"]["new_bonus_percent"] = bonus_percent
+    context.user_data["state"]["step"] = "edit_product_quantity"
+    await update.message.reply_text(
+        f"Yangi bonus foizi saqlandi: {bonus_percent}%\n"
+        f"Joriy miqdor: {state['current_quantity']} dona\n"
+        f"Yangi miqdorni kiriting (yoki o'zgartirmaslik uchun joriy miqdorni qaytaring):"
+    )
+    logger.info("Admin %s yangi bonus foizi kiritdi: %s", user_id, bonus_percent)
+
+async def admin_step_edit_product_quantity(update: Update, context: ContextTypes.DEFAULT_TYPE, state: dict):
+    """Tahrirlanayotgan mahsulotning yangi miqdorini qabul qilib, mahsulotni yangilash"""
+    user_id = str(update.effective_user.id)
+    text = update.message.text.strip()
+    if not NUM_RE.match(text):
+        await update.message.reply_text("Iltimos, to'g'ri miqdor kiriting (masalan, 50).")
+        logger.warning("Admin %s noto'g'ri miqdor formati kiritdi: %s", user_id, text)
+        return
+    quantity = float(text)
+    data = {
+        "group_name": context.user_data.get("selected_group", ""),
+        "name": context.user_data["state"]["new_product_name"],
+        "price": context.user_data["state"]["new_price"],
+        "bonus_percent": context.user_data["state"]["new_bonus_percent"],
+        "quantity": quantity
+    }
+    if await sheet_call(update_product, state["old_product_name"], state["old_group_name"], data):
+        await update.message.reply_text(
+            f"Mahsulot yangilandi:\n"
+            f"Nom: {data['name']}\n"
+            f"Guruh: {data['group_name']}\n"
+            f"Narx: {format_currency(data['price'])}\n"
+            f"Bonus foizi: {data['bonus_percent']}%\n"
+            f"Miqdori: {data['quantity']} dona"
+        )
+        logger.info("Admin %s mahsulotni yangiladi: %s (%s)", user_id, data['name'], data['group_name'])
+    else:
+        await update.message.reply_text("Mahsulotni yangilashda xato yuz berdi.")
+        logger.error(f"Admin {user_id} mahsulotni yangilashda xato: {data['name']} ({data['group_name']})")
+    context.user_data.pop("state", None)
+    context.user_data.pop("selected_group", None)
+
+ADMIN_STEP_HANDLERS = {
+    "group_name": admin_step_group_name,
+    "product_name": admin_step_product_name,
+    "product_price": admin_step_product_price,
+    "product_bonus": admin_step_product_bonus,
+    "product_quantity": admin_step_product_quantity,
+    "edit_product_name": admin_step_edit_product_name,
+    "edit_product_price": admin_step_edit_product_price,
+    "edit_product_bonus": admin_step_edit_product_bonus,
+    "edit_product_quantity": admin_step_edit_product_quantity,
+}
 
 async def handle_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Admin funksiyalari"""
     user_id = str(update.effective_user.id)
     text = update.message.text.strip()
-    logger.info(f"Admin {user_id} xabari: {text}")
+    logger.info("Admin %s xabari: %s", user_id, text)
 
     try:
         if text == "Yangi guruh qo'shish":
-            USER_STATE[user_id] = {"step": "group_name"}
+            context.user_data["state"] = {"step": "group_name"}
             await update.message.reply_text("Yangi guruh nomini kiriting:")
-            logger.info(f"Admin {user_id} guruh qo'shishni boshladi")
+            logger.info("Admin %s guruh qo'shishni boshladi", user_id)
         elif text == "Mahsulot qo'shish":
-            groups = get_groups()
+            groups = await cached_call(groups_fresh, get_groups)
             if not groups:
                 await update.message.reply_text("Hozirda guruhlar mavjud emas. Avval guruh qo'shing.")
-                logger.info(f"Admin {user_id} mahsulot qo'shishni so'radi, lekin guruhlar yo'q")
+                logger.info("Admin %s mahsulot qo'shishni so'radi, lekin guruhlar yo'q", user_id)
                 return
-            keyboard = [[InlineKeyboardButton(group, callback_data=f"select_group_add_{group}")] for group in groups]
-            reply_markup = InlineKeyboardMarkup(keyboard)
+            reply_markup = group_keyboard(groups, "select_group_add_")
             await update.message.reply_text("Mahsulot qo'shish uchun guruhni tanlang:", reply_markup=reply_markup)
-            logger.info(f"Admin {user_id} mahsulot qo'shish uchun guruh tanlashni boshladi")
+            logger.info("Admin %s mahsulot qo'shish uchun guruh tanlashni boshladi", user_id)
         elif text == "Mahsulotlar ma'lumotlarini o'zgartirish":
-            groups = get_groups()
+            groups = await cached_call(groups_fresh, get_groups)
             if not groups:
                 await update.message.reply_text("Hozirda guruhlar mavjud emas.")
-                logger.info(f"Admin {user_id} mahsulot o'zgartirishni so'radi, lekin guruhlar yo'q")
+                logger.info("Admin %s mahsulot o'zgartirishni so'radi, lekin guruhlar yo'q", user_id)
                 return
-            keyboard = [[InlineKeyboardButton(group, callback_data=f"select_group_edit_{group}")] for group in groups]
-            reply_markup = InlineKeyboardMarkup(keyboard)
+            reply_markup = group_keyboard(groups, "select_group_edit_")
             await update.message.reply_text("Tahrirlamoqchi bo'lgan mahsulot guruhini tanlang:", reply_markup=reply_markup)
-            logger.info(f"Admin {user_id} mahsulot o'zgartirish uchun guruh tanlashni boshladi")
+            logger.info("Admin %s mahsulot o'zgartirish uchun guruh tanlashni boshladi", user_id)
         elif text == "Mahsulot ro'yxati":
-            groups = get_groups()
+            groups = await cached_call(groups_fresh, get_groups)
             if not groups:
                 await update.message.reply_text("Hozirda guruhlar mavjud emas.")
-                logger.info(f"Admin {user_id} mahsulot ro'yxatini so'radi, lekin guruhlar yo'q")
+                logger.info("Admin %s mahsulot ro'yxatini so'radi, lekin guruhlar yo'q", user_id)
                 return
-            text = "Mahsulotlar ro'yxati:\n\n"
+            # Qismlar ro'yxatga yig'ilib bir marta birlashtiriladi (+= har safar butun matnni nusxalaydi)
+            parts = []
             for group in groups:
-                products = get_products(group)
+                products = await cached_call(products_fresh, get_products, group)
                 if products:
-                    text += f"**{group}**:\n"
-                    for p in products:
-                        text += f"  • {p['name']}: {p['quantity']} dona, Narx: {format_currency(p['price'])}, Bonus: {p['bonus_percent']}%\n"
-                    text += "\n"
-            if text == "Mahsulotlar ro'yxati:\n\n":
+                    parts.append(f"**{group}**:\n")
+                    parts.extend(f"  • {p['name']}: {p['quantity']} dona, Narx: {p['price_fmt']}, Bonus: {p['bonus_percent']}%\n" for p in products)
+                    parts.append("\n")
+            if not parts:
                 await update.message.reply_text("Hozirda mahsulotlar mavjud emas.")
-                logger.info(f"Admin {user_id} mahsulot ro'yxatini so'radi, lekin mahsulotlar yo'q")
+                logger.info("Admin %s mahsulot ro'yxatini so'radi, lekin mahsulotlar yo'q", user_id)
             else:
-                await update.message.reply_text(text, parse_mode="Markdown")
-                logger.info(f"Admin {user_id} mahsulot ro'yxatini oldi")
+                await update.message.reply_text("Mahsulotlar ro'yxati:\n\n" + "".join(parts), parse_mode="Markdown")
+                logger.info("Admin %s mahsulot ro'yxatini oldi", user_id)
         elif text == "Buyurtmalar ro'yxati":
-            keyboard = [
-                [InlineKeyboardButton("Ohirgi buyurtma", callback_data="last_order")],
-                [InlineKeyboardButton("Ohirgi 5 ta buyurtma", callback_data="last_5_orders")],
-                [InlineKeyboardButton("Barcha buyurtmalar", callback_data="all_orders")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await update.message.reply_text("Buyurtmalar ro'yxatini qaysi ko'rinishda ko'rmoqchisiz?", reply_markup=reply_markup)
-            logger.info(f"Admin {user_id} buyurtmalar ro'yxatini so'radi")
+            await update.message.reply_text("Buyurtmalar ro'yxatini qaysi ko'rinishda ko'rmoqchisiz?", reply_markup=ORDER_LIST_MENU)
+            logger.info("Admin %s buyurtmalar ro'yxatini so'radi", user_id)
         elif text == "Haridorlar ro'yxati":
-            all_values = HARIDORLAR_SHEET.get_all_values()
-            headers = all_values[0]
-            users = []
-            for row in all_values[1:]:
-                users.append({
-                    "ID": row[0] if len(row) > 0 else "",
-                    "Ism": row[1] if len(row) > 1 else "",
-                    "Bonus": float(row[5] or 0) if len(row) > 5 else 0
-                })
+            users = await cached_call(users_fresh, get_all_users)
             if users:
-                users_text = "\n".join([f"ID: {u['ID']}, Ism: {u['Ism']}, Bonus: {format_currency(u['Bonus'])}" for u in users])
-                await update.message.reply_text(users_text)
-                logger.info(f"Admin {user_id} haridorlar ro'yxatini oldi")
+                # Telegram xabari 4096 belgidan oshmasligi uchun ro'yxat bo'laklab yuboriladi
+                for batch in chunked(users, USER_LIST_CHUNK_SIZE):
+                    await update.message.reply_text("\n".join(f"ID: {u['id']}, Ism: {u['name']}, Bonus: {format_currency(u['bonus'])}" for u in batch))
+                logger.info("Admin %s haridorlar ro'yxatini oldi", user_id)
             else:
                 await update.message.reply_text("Haridorlar yo'q.")
-                logger.info(f"Admin {user_id} haridorlar ro'yxatini so'radi, lekin haridorlar yo'q")
+                logger.info("Admin %s haridorlar ro'yxatini so'radi, lekin haridorlar yo'q", user_id)
         elif text == "Guruh o‘chirish":
-            groups = get_groups()
+            groups = await cached_call(groups_fresh, get_groups)
             if not groups:
                 await update.message.reply_text("Hozirda guruhlar mavjud emas.")
-                logger.info(f"Admin {user_id} guruh o'chirishni so'radi, lekin guruhlar yo'q")
+                logger.info("Admin %s guruh o'chirishni so'radi, lekin guruhlar yo'q", user_id)
                 return
-            keyboard = [[InlineKeyboardButton(group, callback_data=f"delete_group_{group}")] for group in groups]
-            reply_markup = InlineKeyboardMarkup(keyboard)
+            reply_markup = group_keyboard(groups, "delete_group_")
             await update.message.reply_text("O‘chiriladigan guruhni tanlang:", reply_markup=reply_markup)
-            logger.info(f"Admin {user_id} guruh o'chirish uchun guruh tanlashni boshladi")
-        elif user_id in USER_STATE:
-            state = USER_STATE.get(user_id)
+            logger.info("Admin %s guruh o'chirish uchun guruh tanlashni boshladi", user_id)
+        elif "state" in context.user_data:
+            state = context.user_data.get("state")
             if not state:
                 await update.message.reply_text("Xato: Holat topilmadi. Iltimos, /start orqali qaytadan boshlang.")
-                logger.error(f"Admin {user_id} uchun USER_STATE topilmadi")
+                logger.error(f"Admin {user_id} uchun holat topilmadi")
                 return
-            logger.info(f"Admin {user_id} holati: {state['step']}, kiritilgan matn: {text}")
-            if state["step"] == "group_name":
-                if not text.strip():
-                    await update.message.reply_text("Iltimos, guruh nomini kiriting (bo'sh bo'lmasligi kerak).")
-                    return
-                if save_group(text):
-                    await update.message.reply_text(f"Guruh qo'shildi: {text}")
-                    logger.info(f"Admin {user_id} yangi guruh qo'shdi: {text}")
-                else:
-                    await update.message.reply_text("Guruh qo'shishda xato yuz berdi.")
-                del USER_STATE[user_id]
-            elif state["step"] == "product_name":
-                if not text.strip():
-                    await update.message.reply_text("Iltimos, mahsulot nomini kiriting (bo'sh bo'lmasligi kerak).")
-                    return
-                USER_STATE[user_id]["product_name"] = text.strip()
-                USER_STATE[user_id]["step"] = "product_price"
-                await update.message.reply_text("Mahsulot narxini kiriting:")
-                logger.info(f"Admin {user_id} mahsulot nomi kiritdi: {text}")
-            elif state["step"] == "product_price":
-                try:
-                    price = float(text)
-                    if price <= 0:
-                        await update.message.reply_text("Iltimos, 0 dan katta narx kiriting.")
-                        logger.warning(f"Admin {user_id} noto'g'ri narx kiritdi: {text}")
-                        return
-                    USER_STATE[user_id]["product_price"] = price
-                    USER_STATE[user_id]["step"] = "product_bonus"
-                    await update.message.reply_text("Usta uchun bonus foizini kiriting (%):")
-                    logger.info(f"Admin {user_id} mahsulot narxini kiritdi: {price}")
-                except ValueError:
-                    await update.message.reply_text("Iltimos, to'g'ri narx kiriting (masalan, 40000).")
-                    logger.warning(f"Admin {user_id} noto'g'ri narx formati kiritdi: {text}")
-            elif state["step"] == "product_bonus":
-                try:
-                    bonus_percent = float(text)
-                    if bonus_percent < 0:
-                        await update.message.reply_text("Iltimos, 0 yoki undan katta foiz kiriting.")
-                        logger.warning(f"Admin {user_id} noto'g'ri bonus foizi kiritdi: {text}")
-                        return
-                    USER_STATE[user_id]["product_bonus"] = bonus_percent
-                    USER_STATE[user_id]["step"] = "product_quantity"
-                    await update.message.reply_text("Mahsulot miqdorini kiriting (dona):")
-                    logger.info(f"Admin {user_id} bonus foizini kiritdi: {bonus_percent}")
-                except ValueError:
-                    await update.message.reply_text("Iltimos, to'g'ri foiz kiriting (masalan, 12.5).")
-                    logger.warning(f"Admin {user_id} noto'g'ri bonus foizi formati kiritdi: {text}")
-            elif state["step"] == "product_quantity":
-                try:
-                    quantity = float(text)
-                    if quantity < 0:
-                        await update.message.reply_text("Iltimos, 0 yoki undan katta miqdor kiriting.")
-                        logger.warning(f"Admin {user_id} noto'g'ri miqdor kiritdi: {text}")
-                        return
-                    data = {
-                        "group_name": USER_SELECTED_GROUP.get(user_id, ""),
-                        "name": USER_STATE[user_id]["product_name"],
-                        "price": USER_STATE[user_id]["product_price"],
-                        "bonus_percent": USER_STATE[user_id]["product_bonus"],
-                        "quantity": quantity
-                    }
-                    if save_product(data):
-                        await update.message.reply_text(f"Mahsulot qo'shildi: {data['name']} ({data['group_name']})")
-                        logger.info(f"Admin {user_id} yangi mahsulot qo'shdi: {data['name']} ({data['group_name']})")
-                    else:
-                        await update.message.reply_text("Mahsulot qo'shishda xato yuz berdi.")
-                    del USER_STATE[user_id]
-                    del USER_SELECTED_GROUP[user_id]
-                except ValueError:
-                    await update.message.reply_text("Iltimos, to'g'ri miqdor kiriting (masalan, 50).")
-                    logger.warning(f"Admin {user_id} noto'g'ri miqdor formati kiritdi: {text}")
-            elif state["step"] == "edit_product_name":
-                if not text.strip():
-                    await update.message.reply_text("Iltimos, mahsulot nomini kiriting (bo'sh bo'lmasligi kerak).")
-                    logger.warning(f"Admin {user_id} bo'sh mahsulot nomi kiritdi")
-                    return
-                USER_STATE[user_id]["new_product_name"] = text.strip()
-                USER_STATE[user_id]["step"] = "edit_product_price"
-                await update.message.reply_text(
-                    f"Yangi nom saqlandi: {text.strip()}\n"
-                    f"Joriy narx: {format_currency(state['current_price'])}\n"
-                    f"Yangi narx kiriting (yoki o'zgartirmaslik uchun joriy narxni qaytaring):"
-                )
-                logger.info(f"Admin {user_id} yangi mahsulot nomi kiritdi: {text.strip()}")
-            elif state["step"] == "edit_product_price":
-                try:
-                    price = float(text)
-                    if price <= 0:
-                        await update.message.reply_text("Iltimos, 0 dan katta narx kiriting.")
-                        logger.warning(f"Admin {user_id} noto'g'ri narx kiritdi: {text}")
-                        return
-                    USER_STATE[user_id]["new_price"] = price
-                    USER_STATE[user_id]["step"] = "edit_product_bonus"
-                    await update.message.reply_text(
-                        f"Yangi narx saqlandi: {format_currency(price)}\n"
-                        f"Joriy bonus foizi: {state['current_bonus_percent']}%\n"
-                        f"Yangi bonus foizini kiriting (yoki o'zgartirmaslik uchun joriy foizni qaytaring):"
-                    )
-                    logger.info(f"Admin {user_id} yangi narx kiritdi: {price}")
-                except ValueError:
-                    await update.message.reply_text("Iltimos, to'g'ri narx kiriting (masalan, 40000).")
-                    logger.warning(f"Admin {user_id} noto'g'ri narx formati kiritdi: {text}")
-            elif state["step"] == "edit_product_bonus":
-                try:
-                    bonus_percent = float(text)
-                    if bonus_percent < 0:
-                        await update.message.reply_text("Iltimos, 0 yoki undan katta foiz kiriting.")
-                        logger.warning(f"Admin {user_id} noto'g'ri bonus foizi kiritdi: {text}")
-                        return
-                    USER_STATE[user_id]["new_bonus_percent"] = bonus_percent
-                    USER_STATE[user_id]["step"] = "edit_product_quantity"
-                    await update.message.reply_text(
-                        f"Yangi bonus foizi saqlandi: {bonus_percent}%\n"
-                        f"Joriy miqdor: {state['current_quantity']} dona\n"
-                        f"Yangi miqdorni kiriting (yoki o'zgartirmaslik uchun joriy miqdorni qaytaring):"
-                    )
-                    logger.info(f"Admin {user_id} yangi bonus foizi kiritdi: {bonus_percent}")
-                except ValueError:
-                    await update.message.reply_text("Iltimos, to'g'ri foiz kiriting (masalan, 12.5).")
-                    logger.warning(f"Admin {user_id} noto'g'ri bonus foizi formati kiritdi: {text}")
-            elif state["step"] == "edit_product_quantity":
-                try:
-                    quantity = float(text)
-                    if quantity < 0:
-                        await update.message.reply_text("Iltimos, 0 yoki undan katta miqdor kiriting.")
-                        logger.warning(f"Admin {user_id} noto'g'ri miqdor kiritdi: {text}")
-                        return
-                    data = {
-                        "group_name": USER_SELECTED_GROUP.get(user_id, ""),
-                        "name": USER_STATE[user_id]["new_product_name"],
-                        "price": USER_STATE[user_id]["new_price"],
-                        "bonus_percent": USER_STATE[user_id]["new_bonus_percent"],
-                        "quantity": quantity
-                    }
-                    if update_product(state["old_product_name"], state["old_group_name"], data):
-                        await update.message.reply_text(
-                            f"Mahsulot yangilandi:\n"
-                            f"Nom: {data['name']}\n"
-                            f"Guruh: {data['group_name']}\n"
-                            f"Narx: {format_currency(data['price'])}\n"
-                            f"Bonus foizi: {data['bonus_percent']}%\n"
-                            f"Miqdori: {data['quantity']} dona"
-                        )
-                        logger.info(f"Admin {user_id} mahsulotni yangiladi: {data['name']} ({data['group_name']})")
-                    else:
-                        await update.message.reply_text("Mahsulotni yangilashda xato yuz berdi.")
-                        logger.error(f"Admin {user_id} mahsulotni yangilashda xato: {data['name']} ({data['group_name']})")
-                    del USER_STATE[user_id]
-                    del USER_SELECTED_GROUP[user_id]
-                except ValueError:
-                    await update.message.reply_text("Iltimos, to'g'ri miqdor kiriting (masalan, 50).")
-                    logger.warning(f"Admin {user_id} noto'g'ri miqdor formati kiritdi: {text}")
+            logger.info("Admin %s holati: %s, kiritilgan matn: %s", user_id, state['step'], text)
+            handler = ADMIN_STEP_HANDLERS.get(state["step"])
+            if handler:
+                await handler(update, context, state)
 
     except Exception as e:
         logger.error(f"Xato admin funksiyasida: {e}", exc_info=True)
@@ -1350,10 +2043,43 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except Exception as e:
         logger.error(f"Error in error_handler: {e}", exc_info=True)
 
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """Turli chatlarning yangilanishlari parallel, bitta chatniki esa kelgan tartibida ketma-ket qayta ishlanadi"""
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        self._chat_locks = {}  # {chat ID: [asyncio.Lock, kutayotganlar soni]}
+
+    async def process_update(self, update, coroutine):
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            await super().process_update(update, coroutine)
+            return
+        entry = self._chat_locks.get(chat.id)
+        if entry is None:
+            entry = self._chat_locks[chat.id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            # Chat navbati semafordan oldin kutiladi: bitta chatning kutayotgan yangilanishlari umumiy o'rinlarni band qilmaydi
+            async with entry[0]:
+                await super().process_update(update, coroutine)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._chat_locks[chat.id]
+
+    async def do_process_update(self, update, coroutine):
+        await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
 class HealthCheckHandler(BaseHTTPRequestHandler):
-    """Render platformasi uchun /health endpointi"""
+    """Polling rejimida (8000 portda) / va /health endpointlari"""
     def do_GET(self):
-        if self.path == "/health":
+        if self.path in ("/", "/health"):
             self.send_response(200)
             self.send_header("Content-type", "text/plain")
             self.end_headers()
@@ -1369,24 +2095,203 @@ def run_health_check_server():
     logger.info("Starting health check server on port 8000...")
     httpd.serve_forever()
 
+class WebhookHealthHandler(tornado.web.RequestHandler):
+    """Webhook rejimida Render uchun / va /health endpointlari"""
+    def get(self):
+        self.write("OK")
+
+    def head(self):
+        pass
+
+class WebhookUpdateHandler(tornado.web.RequestHandler):
+    """Telegram webhook so'rovini Update'ga aylantirib, application.update_queue'ga qo'yish"""
+    def initialize(self, bot_app, secret_token):
+        self.bot_app = bot_app
+        self.secret_token = secret_token
+
+    async def post(self):
+        if self.secret_token and self.request.headers.get("X-Telegram-Bot-Api-Secret-Token") != self.secret_token:
+            raise tornado.web.HTTPError(403)
+        try:
+            update = Update.de_json(json.loads(self.request.body), self.bot_app.bot)
+        except Exception as e:
+            logger.error(f"Webhook so'rovini o'qib bo'lmadi: {e}")
+            raise tornado.web.HTTPError(400)
+        await self.bot_app.update_queue.put(update)
+
+async def run_webhook_server(application: Application, webhook_base_url):
+    """Webhook, / va /health marshrutlarini $PORT'dagi bitta serverda ishga tushirish"""
+    # Render tashqi trafikni ham, health check'ni ham $PORT'ga yuboradi, shuning uchun ular bitta serverda
+    secret_token = os.getenv("WEBHOOK_SECRET")
+    web_app = tornado.web.Application([
+        (r"/(?:health)?", WebhookHealthHandler),
+        (f"/{re.escape(BOT_TOKEN)}", WebhookUpdateHandler, {"bot_app": application, "secret_token": secret_token}),
+    ])
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+    await application.initialize()
+    try:
+        # run_webhook/run_polling'dan farqli, bu yo'lda post_init va post_shutdown qo'lda chaqiriladi
+        await post_init(application)
+        server = web_app.listen(int(os.getenv("PORT", "8443")), address="0.0.0.0")
+        try:
+            await application.bot.set_webhook(
+                url=f"{webhook_base_url.rstrip('/')}/{BOT_TOKEN}",
+                secret_token=secret_token,
+                allowed_updates=ALLOWED_UPDATES,
+                max_connections=WEBHOOK_MAX_CONNECTIONS
+            )
+            await application.start()
+            await stop_event.wait()
+            await application.stop()
+        finally:
+            server.stop()
+    finally:
+        await application.shutdown()
+        await post_shutdown(application)
+
+async def track_activity(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Har bir yangilanishda foydalanuvchining oxirgi faollik vaqtini yangilash"""
+    if update.effective_user:
+        USER_LAST_SEEN[update.effective_user.id] = time.time()
+
+async def user_data_cleanup_loop(application: Application):
+    """Uzoq vaqt faol bo'lmagan foydalanuvchilar holatini va eskirgan kutilayotgan buyurtmalarni xotira va persistence'dan o'chirish"""
+    while True:
+        await asyncio.sleep(USER_DATA_CLEANUP_INTERVAL)
+        now = time.time()
+        expired = 0
+        for buyer_id, order in list(ORDER_CACHE.items()):
+            # Vaqti yozilmagan (eski holatdan tiklangan) buyurtmalar hisoblash shu paytdan boshlanadi
+            if now - order.setdefault("created_at", now) >= ORDER_PENDING_TTL:
+                ORDER_CACHE.pop(buyer_id, None)
+                expired += 1
+        if expired:
+            logger.info("%s ta eskirgan tasdiqlanmagan buyurtma o'chirildi", expired)
+        dropped = 0
+        for user_id in list(application.user_data):
+            # Qayta ishga tushirishdan keyin tiklangan foydalanuvchilar hisoblash shu paytdan boshlanadi
+            if now - USER_LAST_SEEN.setdefault(user_id, now) < USER_DATA_IDLE_TTL:
+                continue
+            # Admin tasdig'ini kutayotgan buyurtmaning savati saqlanib qoladi
+            if str(user_id) in ORDER_CACHE:
+                continue
+            application.drop_user_data(user_id)
+            USER_LAST_SEEN.pop(user_id, None)
+            dropped += 1
+        if dropped:
+            logger.info("%s ta faol bo'lmagan foydalanuvchi holati o'chirildi", dropped)
+
+async def state_save_loop(application: Application):
+    """Suhbat holatini BOT_STATE_SAVE_INTERVAL da bir marta faylga yozish"""
+    while True:
+        await asyncio.sleep(BOT_STATE_SAVE_INTERVAL)
+        try:
+            await application.persistence.flush()
+        except Exception as e:
+            logger.error(f"Bot holatini saqlash xatosi: {e}")
+
+async def post_init(application: Application):
+    """Bot ishga tushgach fon vazifalarini boshlash"""
+    global ORDER_FLUSH_TASK, ORDER_FLUSH_EVENT, EVENT_LOOP, CACHE_REFRESH_TASK, USER_DATA_CLEANUP_TASK, STATE_SAVE_TASK, ORDER_CACHE
+    # Kutilayotgan buyurtmalar bot_data ichida saqlanadi, shunda qayta ishga tushirishda yo'qolmaydi
+    ORDER_CACHE = application.bot_data.setdefault("orders", ORDER_CACHE)
+    # Standart executor min(32, cpu+4) thread bilan cheklanadi, kichik serverda Sheets so'rovlari navbatda qoladi
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=SHEET_WORKERS, thread_name_prefix="sheets"))
+    # Birinchi foydalanuvchilar keshlar to'lishini kutmasligi uchun barcha varaqlar bitta so'rovda o'qiladi
+    await sheet_call(warm_caches)
+    ORDER_FLUSH_EVENT = asyncio.Event()
+    EVENT_LOOP = asyncio.get_running_loop()
+    ORDER_FLUSH_TASK = asyncio.create_task(order_flush_loop())
+    CACHE_REFRESH_TASK = asyncio.create_task(cache_refresh_loop())
+    USER_DATA_CLEANUP_TASK = asyncio.create_task(user_data_cleanup_loop(application))
+    STATE_SAVE_TASK = asyncio.create_task(state_save_loop(application))
+
+async def post_shutdown(application: Application):
+    """Bot to'xtaganda navbatda qolgan buyurtmalarni yozib yuborish"""
+    if ORDER_FLUSH_TASK:
+        ORDER_FLUSH_TASK.cancel()
+    if CACHE_REFRESH_TASK:
+        CACHE_REFRESH_TASK.cancel()
+    if USER_DATA_CLEANUP_TASK:
+        USER_DATA_CLEANUP_TASK.cancel()
+    if STATE_SAVE_TASK:
+        STATE_SAVE_TASK.cancel()
+    await sheet_call(flush_order_buffer)
+
+def acquire_instance_lock():
+    """BOT_STATE_FILE uchun jarayonlararo qulf olish (ikkinchi nusxa ishga tushmaydi)"""
+    # Holat, keshlar va buyurtma hisoblagichi jarayon xotirasida: ikki worker bir-birining holatini va qator raqamlarini buzadi
+    if fcntl is None:
+        return None
+    lock_file = open(f"{BOT_STATE_FILE}.lock", "w")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        raise RuntimeError(f"{BOT_STATE_FILE} boshqa jarayon tomonidan ishlatilmoqda, bot faqat bitta jarayonda ishlashi kerak")
+    return lock_file
+
 def main():
     """Botni ishga tushirish"""
+    global INSTANCE_LOCK
     try:
-        init_sheets()
-        # HTTPXRequest sozlamalarini yangilash
-        request = HTTPXRequest(connection_pool_size=20)
-        application = Application.builder().token(BOT_TOKEN).request(request).build()
+        INSTANCE_LOCK = acquire_instance_lock()
+        if not os.path.exists(SHEETS_INIT_MARKER):
+            init_sheets()
+            open(SHEETS_INIT_MARKER, "w").close()
+        # HTTPXRequest sozlamalari: HTTP/2 bitta ulanishda ko'plab so'rovlarni multiplekslaydi
+        request = HTTPXRequest(
+            connection_pool_size=TELEGRAM_POOL_SIZE,
+            http_version="2",
+            connect_timeout=5,
+            read_timeout=20,
+            write_timeout=20,
+            pool_timeout=10
+        )
+        # getUpdates bir vaqtda faqat bitta so'rov yuboradi
+        get_updates_request = HTTPXRequest(connection_pool_size=1, http_version="2", connect_timeout=5, read_timeout=20)
+        application = (
+            Application.builder()
+            .token(BOT_TOKEN)
+            .request(request)
+            .get_updates_request(get_updates_request)
+            .concurrent_updates(PerChatUpdateProcessor(MAX_CONCURRENT_UPDATES))
+            # Foydalanuvchi holati, savat va kutilayotgan buyurtmalar qayta ishga tushirishdan keyin ham saqlanadi
+            .persistence(PicklePersistence(
+                filepath=BOT_STATE_FILE,
+                store_data=PersistenceInput(chat_data=False, callback_data=False),
+                update_interval=BOT_STATE_SAVE_INTERVAL,
+                # Aks holda har bir o'zgargan foydalanuvchi uchun butun fayl qayta pickle qilinadi; state_save_loop bir marta yozadi
+                on_flush=True
+            ))
+            # Umumiy ~28 xabar/s va guruh uchun 20 xabar/daqiqa; 429 (RetryAfter) javobida qayta uriniladi
+            .rate_limiter(AIORateLimiter(overall_max_rate=28, overall_time_period=1, group_max_rate=20, group_time_period=60, max_retries=3))
+            .post_init(post_init)
+            .post_shutdown(post_shutdown)
+            .build()
+        )
 
+        # Faollik vaqti boshqa handlerlardan oldin (-1 guruhida) yoziladi
+        application.add_handler(TypeHandler(Update, track_activity), group=-1)
         application.add_handler(CommandHandler("start", start))
         application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
         application.add_handler(MessageHandler(filters.LOCATION, handle_location))
-        application.add_handler(CallbackQueryHandler(handle_admin_callback, pattern="^(confirm_order_|reject_order_|approve_bonus_|reject_bonus_|approve_edit_|reject_edit_|edit_product_|delete_product_|select_group_edit_|select_group_add_|delete_group_|last_order|last_5_orders|all_orders)"))
+        application.add_handler(CallbackQueryHandler(handle_admin_callback, pattern=ADMIN_CALLBACK_RE))
         application.add_handler(CallbackQueryHandler(handle_callback_query))
         application.add_error_handler(error_handler)
 
-        threading.Thread(target=run_health_check_server, daemon=True).start()
-
-        application.run_polling(allowed_updates=Update.ALL_TYPES)
+        # Tashqi URL (WEBHOOK_URL yoki Render bergan) bo'lsa webhook, aks holda (lokal ishga tushirishda) polling
+        webhook_base_url = os.getenv("WEBHOOK_URL") or os.getenv("RENDER_EXTERNAL_URL")
+        if webhook_base_url:
+            # Health check webhook bilan bir serverda ($PORT), alohida 8000 port serveri ishga tushirilmaydi
+            logger.info("Webhook rejimida ishga tushirilmoqda")
+            asyncio.run(run_webhook_server(application, webhook_base_url))
+        else:
+            threading.Thread(target=run_health_check_server, daemon=True).start()
+            application.run_polling(allowed_updates=ALLOWED_UPDATES)
     except Conflict:
         logger.error("Bot is already running elsewhere. Terminating.")
     except Exception as e: